@@ -0,0 +1,20 @@
+def open(filename, encoding='utf-8', mode=None, shared_cache=False):
+    """Open an HDF4 or HDF-EOS2 file, or a store written by ccplot-convert.
+    A store is returned as an instance of ccplot.store.Store. Other files
+    are opened as HDF and probed for the HDFEOSVersion global attribute.
+    Returns an instance of ccplot.hdfeos.HDFEOS sharing the open HDF file
+    if the attribute is present, or the instance of ccplot.hdf.HDF
+    otherwise. shared_cache is passed to ccplot.hdf.HDF."""
+    from ccplot.hdf import HDF
+    from ccplot.hdfeos import HDFEOS
+    from ccplot.store import Store, is_store
+    if is_store(filename):
+        return Store(filename, encoding, mode)
+    product = HDF(filename, encoding, mode, shared_cache=shared_cache)
+    if b'HDFEOSVersion' not in product.attributes._load():
+        return product
+    try:
+        return HDFEOS(filename, encoding, mode, hdffile=product)
+    except:
+        product.close()
+        raise
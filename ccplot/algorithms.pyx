@@ -1,6 +1,11 @@
 cimport cython
 cimport numpy as np
 import numpy as np
+import os
+import hashlib
+import zipfile
+from cython.parallel cimport prange
+from libc.math cimport NAN
 
 cdef extern from "math.h":
     double floor(double)
@@ -8,14 +13,32 @@ cdef extern from "math.h":
     double round(double)
 
 cdef extern from "numpy/npy_math.h":
-    bint npy_isnan(double x)
+    bint npy_isnan(double x) nogil
+
+
+def _nthreads(threads, int nx, int nz, float x1, float x2, float z1,
+              float z2):
+    # Validate the output grid and return the number of threads to use.
+    if nx <= 0 or nz <= 0:
+        raise ValueError('nx and nz must be positive')
+    if x1 == x2 or z1 == z2:
+        raise ValueError('x1 and x2, and z1 and z2 must differ')
+    if threads is None: threads = os.cpu_count() or 1
+    return max(1, min(int(threads), nx))
+
+
+def _check_coords(data, X, Z):
+    w, h = data.shape[-2], data.shape[-1]
+    if X.shape[0] < w or Z.shape[0] < w or Z.shape[1] < h:
+        raise ValueError('X and Z must not be smaller than data')
 
 
 def interp2d_12(np.ndarray[float, ndim=2, mode="c"] data not None,
                 np.ndarray[float, ndim=1, mode="c"] X not None,
                 np.ndarray[float, ndim=2, mode="c"] Z not None,
                 float x1, float x2, int nx,
-                float z1, float z2, int nz):
+                float z1, float z2, int nz,
+                threads=None):
     """Interpolate 2D data with coordinates given by 1D and 2D arrays.
 
     data is a two-dimensional array of data to be interpolated.
@@ -24,42 +47,453 @@ def interp2d_12(np.ndarray[float, ndim=2, mode="c"] data not None,
 
     data, X and Z are expected to be C-contiguous float32 numpy arrays
     with no mask and no transformation (such as transposition) applied.
+
+    threads is the number of threads to use (the number of CPUs if None).
+    The output is split between threads along the first axis, and the
+    result does not depend on the number of threads.
     """
-    cdef int i, j, n, m
-    cdef float n1, n2
-    cdef float m1, m2
+    return interp2d_12_stack(data[np.newaxis], X, Z, x1, x2, nx, z1, z2, nz,
+                             threads)[0]
+
+
+def interp2d_12_stack(np.ndarray[float, ndim=3, mode="c"] data not None,
+                      np.ndarray[float, ndim=1, mode="c"] X not None,
+                      np.ndarray[float, ndim=2, mode="c"] Z not None,
+                      float x1, float x2, int nx,
+                      float z1, float z2, int nz,
+                      threads=None, return_counts=False):
+    """Interpolate a stack of 2D data with the same coordinates in one pass.
+
+    data is a three-dimensional array of k fields (along the first axis)
+    defined on the coordinates X and Z. The result is an array of shape
+    (k, nx, nz), equal to interp2d_12 of every field, but the footprint of
+    every data point is computed only once for all fields. NaN are ignored
+    in every field separately. If return_counts is True, a tuple of
+    the result and an int32 array of shape (k, nx, nz) of the number of
+    non-NaN data points averaged in every pixel is returned.
+    """
+    cdef int nthreads = _nthreads(threads, nx, nz, x1, x2, z1, z2)
     cdef float xs, zs
-    cdef int w, h
+    _check_coords(data, X, Z)
 
     xs = (x2 - x1)/nx
     zs = (z2 - z1)/nz
-    w = data.shape[0]
-    h = data.shape[1]
+    output = np.zeros((data.shape[0], nx, nz), dtype=np.float32)
+    q = np.zeros((data.shape[0], nx, nz), dtype=np.int32)
+    nrange = np.empty((data.shape[1], 2), dtype=np.int32)
+    _interp2d_12(data, X, Z, x1, xs, nx, z1, zs, nz, nrange, output, q,
+                 nthreads)
+    return (output, q) if return_counts else output
+
 
-    output = np.zeros((nx, nz), dtype=np.float32)
-    cdef np.ndarray[float, ndim=2] out = output
-    cdef np.ndarray[int, ndim=2] q = np.zeros((nx, nz), dtype=np.int32)
+@cython.cdivision(True)
+cdef inline void _footprint(float *C, int i, int w, float c1, float cs,
+                            int nc, int *r0, int *r1) noexcept nogil:
+    # Range [r0, r1) of output pixels covered by the footprint of data
+    # point i of coordinates C[0:w]. Midpoints are rounded to float before
+    # they are divided by cs, as in the serial interp2d_12, which decides
+    # the footprint of points close to pixel boundaries.
+    cdef float c, c2, c3
+    if i-1 >= 0:
+        c = (C[i-1] + C[i])/2 - c1
+        c2 = c/cs
+    else:
+        c2 = -1
+    if i+1 < w:
+        c = (C[i+1] + C[i])/2 - c1
+        c3 = c/cs
+    else:
+        c3 = nc
+    if c3 - c2 < 1: c2 = c3 = (C[i] - c1)/cs
+    r0[0] = <int>(c2+0.5)
+    r1[0] = <int>(c3+0.5+1)
 
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _nrange(float[::1] X, int w, float x1, float xs, int nx,
+                  int[:, ::1] nrange) noexcept nogil:
+    # Range [nrange[i,0], nrange[i,1]) of output columns covered by each
+    # input column i.
+    cdef int i
     for i in range(w):
-        n1 = ((X[i-1] + X[i])/2 - x1)/xs if i-1 >= 0 else -1
-        n2 = ((X[i+1] + X[i])/2 - x1)/xs if i+1 < w else nx
-        if n2 - n1 < 1: n1 = n2 = (X[i] - x1)/xs
-
-        for j in range(h):
-            m1 = ((Z[i,j-1] + Z[i,j])/2 - z1)/zs if j-1 >= 0 else -1
-            m2 = ((Z[i,j+1] + Z[i,j])/2 - z1)/zs if j+1 < h else nz
-            if m2 - m1 < 1: m1 = m2 = (Z[i,j] - z1)/zs
-
-            for n in range(<int>(n1+0.5), <int>(n2+0.5+1)):
-                for m in range(<int>(m1+0.5), <int>(m2+0.5+1)):
-                    if n < 0 or n >= nx: continue
-                    if m < 0 or m >= nz: continue
-                    if npy_isnan(data[i,j]): continue
-                    out[n,m] += data[i,j]
-                    q[n,m] += 1
-
-    for n in range(nx):
-        for m in range(nz):
-            out[n,m] /= q[n,m]
-
-    return output
+        _footprint(&X[0], i, w, x1, xs, nx, &nrange[i,0], &nrange[i,1])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _interp2d_12(float[:, :, ::1] data, float[::1] X, float[:, ::1] Z,
+                       float x1, float xs, int nx,
+                       float z1, float zs, int nz,
+                       int[:, ::1] nrange, float[:, :, ::1] out,
+                       int[:, :, ::1] q, int nthreads) noexcept nogil:
+    cdef int i, j, n, m, k, f
+    cdef int n0, n3, m0, m3, k1, k2
+    cdef float d
+    cdef int nf = data.shape[0]
+    cdef int w = data.shape[1]
+    cdef int h = data.shape[2]
+
+    _nrange(X, w, x1, xs, nx, nrange)
+
+    # Every thread owns a block of output columns [k1, k2) and adds input
+    # data to it in the same order as a single thread would.
+    for k in prange(nthreads, num_threads=nthreads, schedule='static'):
+        k1 = <int>(<long long>nx*k/nthreads)
+        k2 = <int>(<long long>nx*(k+1)/nthreads)
+        for i in range(w):
+            n0 = max(nrange[i,0], k1)
+            n3 = min(nrange[i,1], k2)
+            if n0 >= n3: continue
+
+            for j in range(h):
+                _footprint(&Z[i,0], j, h, z1, zs, nz, &m0, &m3)
+                m0 = max(m0, 0)
+                m3 = min(m3, nz)
+
+                for f in range(nf):
+                    d = data[f,i,j]
+                    if npy_isnan(d): continue
+                    for n in range(n0, n3):
+                        for m in range(m0, m3):
+                            out[f,n,m] += d
+                            q[f,n,m] += 1
+
+    for n in prange(nx, num_threads=nthreads, schedule='static'):
+        for f in range(nf):
+            for m in range(nz):
+                out[f,n,m] /= q[f,n,m]
+
+
+def interp2d_12_sat(np.ndarray[float, ndim=2, mode="c"] data not None,
+                    np.ndarray[float, ndim=1, mode="c"] X not None,
+                    np.ndarray[float, ndim=2, mode="c"] Z not None,
+                    float x1, float x2, int nx,
+                    float z1, float z2, int nz,
+                    threads=None):
+    """Interpolate 2D data with coordinates given by 1D and 2D arrays
+    using summed-area tables.
+
+    Arguments and result are the same as of interp2d_12: every output pixel
+    is the mean of data points whose footprint covers it, ignoring NaN.
+    Instead of adding every data point to every pixel of its footprint,
+    the footprint is added to a table of differences at its four corners,
+    and pixels are computed from cumulative sums of the table. The cost is
+    proportional to the number of data points plus the number of pixels,
+    regardless of the size of footprints. Sums are computed in double
+    precision, so the result can differ from interp2d_12 by rounding.
+    """
+    return interp2d_12_sat_stack(data[np.newaxis], X, Z, x1, x2, nx,
+                                 z1, z2, nz, threads)[0]
+
+
+def interp2d_12_sat_stack(np.ndarray[float, ndim=3, mode="c"] data not None,
+                          np.ndarray[float, ndim=1, mode="c"] X not None,
+                          np.ndarray[float, ndim=2, mode="c"] Z not None,
+                          float x1, float x2, int nx,
+                          float z1, float z2, int nz,
+                          threads=None, return_counts=False):
+    """Interpolate a stack of 2D data with the same coordinates in one pass
+    using summed-area tables. The same as interp2d_12_stack, but with
+    the algorithm of interp2d_12_sat."""
+    cdef int nthreads = _nthreads(threads, nx, nz, x1, x2, z1, z2)
+    cdef float xs, zs
+    _check_coords(data, X, Z)
+
+    xs = (x2 - x1)/nx
+    zs = (z2 - z1)/nz
+    k = data.shape[0]
+    output = np.empty((k, nx, nz), dtype=np.float32)
+    counts = np.empty((k, nx, nz), dtype=np.int32)
+    # Every thread has its own block of rows of the tables, with one extra
+    # row for the lower edge of the block.
+    s = np.zeros((k, nx + nthreads, nz + 1), dtype=np.float64)
+    q = np.zeros((k, nx + nthreads, nz + 1), dtype=np.int32)
+    nrange = np.empty((data.shape[1], 2), dtype=np.int32)
+    _interp2d_12_sat(data, X, Z, x1, xs, nx, z1, zs, nz, nrange, output,
+                     counts, s, q, nthreads)
+    return (output, counts) if return_counts else output
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _interp2d_12_sat(float[:, :, ::1] data, float[::1] X,
+                           float[:, ::1] Z,
+                           float x1, float xs, int nx,
+                           float z1, float zs, int nz,
+                           int[:, ::1] nrange, float[:, :, ::1] out,
+                           int[:, :, ::1] counts,
+                           double[:, :, ::1] s, int[:, :, ::1] q,
+                           int nthreads) noexcept nogil:
+    cdef int i, j, n, m, k, r, f
+    cdef int n0, n3, m0, m3, k1, k2
+    cdef float d
+    cdef double ssum
+    cdef int qsum
+    cdef int nf = data.shape[0]
+    cdef int w = data.shape[1]
+    cdef int h = data.shape[2]
+
+    _nrange(X, w, x1, xs, nx, nrange)
+
+    for k in prange(nthreads, num_threads=nthreads, schedule='static'):
+        # Output columns [k1, k2) are in rows [r, r + k2 - k1] of s and q.
+        k1 = <int>(<long long>nx*k/nthreads)
+        k2 = <int>(<long long>nx*(k+1)/nthreads)
+        r = k1 + k
+        for i in range(w):
+            n0 = max(nrange[i,0], k1)
+            n3 = min(nrange[i,1], k2)
+            if n0 >= n3: continue
+            n0 = n0 - k1 + r
+            n3 = n3 - k1 + r
+
+            for j in range(h):
+                _footprint(&Z[i,0], j, h, z1, zs, nz, &m0, &m3)
+                m0 = max(m0, 0)
+                m3 = min(m3, nz)
+                if m0 >= m3: continue
+
+                for f in range(nf):
+                    d = data[f,i,j]
+                    if npy_isnan(d): continue
+                    s[f,n0,m0] += d
+                    s[f,n0,m3] -= d
+                    s[f,n3,m0] -= d
+                    s[f,n3,m3] += d
+                    q[f,n0,m0] += 1
+                    q[f,n0,m3] -= 1
+                    q[f,n3,m0] -= 1
+                    q[f,n3,m3] += 1
+
+        for f in range(nf):
+            for n in range(k1, k2):
+                i = n - k1 + r
+                ssum = 0
+                qsum = 0
+                for m in range(nz):
+                    ssum = ssum + s[f,i,m]
+                    qsum = qsum + q[f,i,m]
+                    if n > k1:
+                        s[f,i,m] = ssum + s[f,i-1,m]
+                        q[f,i,m] = qsum + q[f,i-1,m]
+                    else:
+                        s[f,i,m] = ssum
+                        q[f,i,m] = qsum
+                    counts[f,n,m] = q[f,i,m]
+                    out[f,n,m] = s[f,i,m]/q[f,i,m] if q[f,i,m] > 0 else NAN
+
+
+# Version of the format of files written by RegridPlan.save. Version 1
+# plans were built with footprints which could differ from interp2d_12.
+REGRID_PLAN_VERSION = 2
+
+
+def geometry_hash(X, Z, float x1, float x2, int nx, float z1, float z2,
+                  int nz):
+    """Return a hexadecimal SHA-1 hash of the geometry of a regrid plan
+    (arguments as of RegridPlan)."""
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    Z = np.ascontiguousarray(Z, dtype=np.float32)
+    h = hashlib.sha1()
+    h.update(b'interp2d_12 %d' % REGRID_PLAN_VERSION)
+    h.update(np.array(X.shape + Z.shape + (nx, nz), dtype=np.int64).tobytes())
+    h.update(np.array([x1, x2, z1, z2], dtype=np.float32).tobytes())
+    h.update(X.tobytes())
+    h.update(Z.tobytes())
+    return h.hexdigest()
+
+
+class RegridPlan(object):
+    """Mapping of data points to pixels of interp2d_12, built once from
+    the coordinates X and Z and the output grid (arguments as of
+    interp2d_12) and applicable to any number of data arrays of shape
+    (len(X), Z.shape[1]).
+
+    The mapping is stored as a sparse matrix in the compressed sparse row
+    format: data points covering pixel p (of nx*nz, in C order) are the
+    flat indices indices[indptr[p]:indptr[p+1]] of data. Applying the plan
+    gives the same result as interp2d_12. Plans can be saved to a file
+    and loaded, which is useful when the geometry is the same for many
+    products, as the altitudes of CALIPSO profile products are.
+    """
+    def __init__(self, X, Z, float x1, float x2, int nx, float z1, float z2,
+                 int nz, threads=None):
+        cdef int nthreads = _nthreads(threads, nx, nz, x1, x2, z1, z2)
+        cdef float xs, zs
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        Z = np.ascontiguousarray(Z, dtype=np.float32)
+        if X.ndim != 1 or Z.ndim != 2 or Z.shape[0] < X.shape[0]:
+            raise ValueError('X and Z must be one- and two-dimensional arrays covering the same data')
+        w, h = X.shape[0], Z.shape[1]
+        if w*h >= 2**31:
+            raise ValueError('data too large')
+        xs = (x2 - x1)/nx
+        zs = (z2 - z1)/nz
+        indptr = np.zeros(nx*nz + 1, dtype=np.int64)
+        nrange = np.empty((w, 2), dtype=np.int32)
+        _regrid_plan(X, Z[:w], x1, xs, nx, z1, zs, nz, nrange, indptr,
+                     None, nthreads)
+        np.cumsum(indptr, out=indptr)
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        _regrid_plan(X, Z[:w], x1, xs, nx, z1, zs, nz, nrange,
+                     indptr[:-1].copy(), indices, nthreads)
+        self.shape = (w, h)
+        self.grid = (x1, x2, nx, z1, z2, nz)
+        self.indptr = indptr
+        self.indices = indices
+        self.hash = geometry_hash(X, Z, x1, x2, nx, z1, z2, nz)
+
+    @property
+    def nnz(self):
+        """Number of non-zero elements of the matrix."""
+        return len(self.indices)
+
+    def apply(self, data, threads=None, return_counts=False):
+        """Regrid data, a float32 array of the shape of the plan or a stack
+        of such arrays (as in interp2d_12_stack). Returns an array of shape
+        (nx, nz) or (k, nx, nz). If return_counts is True, a tuple of
+        the result and an int32 array of the number of non-NaN data points
+        averaged in every pixel is returned."""
+        cdef int nthreads
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if data.shape[-2:] != self.shape or data.ndim not in (2, 3):
+            raise ValueError('data must have shape %s or (k,) + %s' %
+                (self.shape, self.shape))
+        x1, x2, nx, z1, z2, nz = self.grid
+        nthreads = _nthreads(threads, nx, nz, x1, x2, z1, z2)
+        stack = data.reshape((-1, self.shape[0]*self.shape[1]))
+        output = np.empty((stack.shape[0], nx*nz), dtype=np.float32)
+        q = np.empty((stack.shape[0], nx*nz), dtype=np.int32)
+        _regrid_plan_apply(self.indptr, self.indices, stack, output, q,
+                           nthreads)
+        shape = data.shape[:-2] + (nx, nz)
+        output = output.reshape(shape)
+        return (output, q.reshape(shape)) if return_counts else output
+
+    def save(self, filename):
+        """Save the plan to a file filename."""
+        filename = os.fsdecode(filename)
+        tmp = filename + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f,
+                version=REGRID_PLAN_VERSION,
+                hash=self.hash,
+                shape=np.array(self.shape, dtype=np.int64),
+                grid=np.array(self.grid, dtype=np.float64),
+                indptr=self.indptr,
+                indices=self.indices,
+            )
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename, hash=None):
+        """Load a plan saved by save from a file filename. If hash is not
+        None, raises ValueError unless the plan has the geometry hash hash
+        (see geometry_hash)."""
+        with np.load(os.fsdecode(filename), allow_pickle=False) as f:
+            if int(f['version']) != REGRID_PLAN_VERSION:
+                raise ValueError('unsupported regrid plan version %d' %
+                    int(f['version']))
+            plan = cls.__new__(cls)
+            plan.hash = str(f['hash'])
+            if hash is not None and plan.hash != hash:
+                raise ValueError('regrid plan geometry does not match')
+            plan.shape = tuple(int(n) for n in f['shape'])
+            grid = f['grid']
+            plan.grid = (float(grid[0]), float(grid[1]), int(grid[2]),
+                         float(grid[3]), float(grid[4]), int(grid[5]))
+            plan.indptr = f['indptr']
+            plan.indices = f['indices']
+        return plan
+
+
+def regrid_plan(X, Z, float x1, float x2, int nx, float z1, float z2, int nz,
+                cache_dir=None, threads=None):
+    """Return a RegridPlan (arguments as of RegridPlan). If cache_dir is not
+    None, the plan is loaded from the directory cache_dir if saved there
+    before, or saved there otherwise. Plans are saved in files named after
+    their geometry hash."""
+    if cache_dir is None:
+        return RegridPlan(X, Z, x1, x2, nx, z1, z2, nz, threads)
+    hash = geometry_hash(X, Z, x1, x2, nx, z1, z2, nz)
+    filename = os.path.join(os.fsdecode(cache_dir), hash + '.npz')
+    try:
+        return RegridPlan.load(filename, hash)
+    except (IOError, ValueError, KeyError, zipfile.BadZipFile):
+        pass
+    plan = RegridPlan(X, Z, x1, x2, nx, z1, z2, nz, threads)
+    os.makedirs(os.fsdecode(cache_dir), exist_ok=True)
+    plan.save(filename)
+    return plan
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _regrid_plan(float[::1] X, float[:, ::1] Z,
+                       float x1, float xs, int nx,
+                       float z1, float zs, int nz,
+                       int[:, ::1] nrange, long long[::1] ptr,
+                       int[::1] indices, int nthreads) noexcept nogil:
+    # Count data points covering every pixel in ptr[p+1] (if indices is
+    # None), or store data points covering pixel p at indices[ptr[p]] and
+    # beyond, in the order of data.
+    cdef int i, j, n, m, k
+    cdef int n0, n3, m0, m3, k1, k2
+    cdef long long t
+    cdef bint count = indices is None
+    cdef int w = X.shape[0]
+    cdef int h = Z.shape[1]
+
+    _nrange(X, w, x1, xs, nx, nrange)
+
+    for k in prange(nthreads, num_threads=nthreads, schedule='static'):
+        k1 = <int>(<long long>nx*k/nthreads)
+        k2 = <int>(<long long>nx*(k+1)/nthreads)
+        for i in range(w):
+            n0 = max(nrange[i,0], k1)
+            n3 = min(nrange[i,1], k2)
+            if n0 >= n3: continue
+
+            for j in range(h):
+                _footprint(&Z[i,0], j, h, z1, zs, nz, &m0, &m3)
+                m0 = max(m0, 0)
+                m3 = min(m3, nz)
+
+                for n in range(n0, n3):
+                    for m in range(m0, m3):
+                        if count:
+                            ptr[n*nz + m + 1] += 1
+                        else:
+                            t = ptr[n*nz + m]
+                            indices[t] = i*h + j
+                            ptr[n*nz + m] = t + 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _regrid_plan_apply(long long[::1] indptr, int[::1] indices,
+                             float[:, ::1] data, float[:, ::1] out,
+                             int[:, ::1] q, int nthreads) noexcept nogil:
+    cdef long long p, t
+    cdef int f, c
+    cdef float s, d
+    cdef int nf = data.shape[0]
+    cdef long long npix = indptr.shape[0] - 1
+
+    for p in prange(npix, num_threads=nthreads, schedule='static'):
+        for f in range(nf):
+            s = 0
+            c = 0
+            for t in range(indptr[p], indptr[p+1]):
+                d = data[f,indices[t]]
+                if npy_isnan(d): continue
+                s = s + d
+                c = c + 1
+            out[f,p] = s/c
+            q[f,p] = c
@@ -1,5 +1,10 @@
 import os
 import locale
+import functools
+
+
+def _decode(x, encoding):
+    return x.decode(encoding) if type(x) is bytes else x
 
 
 def autostr(arg):
@@ -8,29 +13,35 @@ def autostr(arg):
     elif not callable(arg):
         return arg
     f = arg
+    init = f.__name__ == "__init__"
+    @functools.wraps(f)
     def f2(self, *args, **kwargs):
-        if f.__name__ == "__init__":
+        if init:
             if hasattr(args[0], "_encoding"):
                 self._encoding = args[0]._encoding
             if hasattr(args[0], "_mode"):
                 self._mode = args[0]._mode
-        args = [x.encode(self._encoding) if type(x) is str else x for x in args]
+        # Fast path: nothing to encode on input and nothing to decode
+        # on output.
+        if self._mode == "binary" and not kwargs:
+            for x in args:
+                if type(x) is str: break
+            else:
+                return f(self, *args)
+        args = [x.encode(self._encoding) if type(x) is str else x
+            for x in args]
         kwargs = {k: (v.encode(self._encoding) if type(v) is str else v)
             for k, v in kwargs.items()}
         out = f(self, *args, **kwargs)
         if self._mode == "text":
-            if type(out) is bytes:
+            t = type(out)
+            if t is bytes:
                 return out.decode(self._encoding)
-            elif type(out) is list:
-                return [x.decode(self._encoding) if type(x) is bytes else x
-                    for x in out]
-            elif type(out) is dict:
-                return { \
-                    (k.decode(self._encoding) if type(k) is bytes else k): \
-                    (v.decode(self._encoding) if type(v) is bytes else v)
+            elif t is list:
+                return [_decode(x, self._encoding) for x in out]
+            elif t is dict:
+                return {_decode(k, self._encoding): _decode(v, self._encoding)
                     for k, v in out.items()}
-            else:
-                return out
         return out
     return f2
 
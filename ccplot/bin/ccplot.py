@@ -60,13 +60,11 @@ import cartopy
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
-from ccplot.hdf import HDF
-from ccplot.hdfeos import HDFEOS
-
 # CCTK is a helper module that performs various calculations.
 from ccplot import cctk
 
 import ccplot.algorithms
+import ccplot.layers
 import ccplot.utils
 
 
@@ -234,6 +232,7 @@ class Swath(object):
     lon = np.empty(0, dtype=np.float64)
     lat = np.empty(0, dtype=np.float64)
     data = np.empty(0, dtype=np.float64)
+    step = 1 # Decimation factor relative to the native resolution.
 
 
 class AutoOpts(object):
@@ -322,6 +321,7 @@ class PlotOpts(AutoOpts):
     padding = 1.0
     parallelsbase = 0
     plotheight = 6.0
+    regrid = "footprint"
     title = None
     trajcolors = ("#FF0000", "#0000FF", "#00FF00")
     trajlws = (0.5,)
@@ -362,6 +362,7 @@ class PlotOpts(AutoOpts):
         elif o == "padding": q = self.setfloat(o, v, 0)
         elif o == "parallelsbase": q = self.setfloat(o, v, 0)
         elif o == "plotheight": q = self.setfloat(o, v, 0)
+        elif o == "regrid": q = self.setenum(o, v, ("footprint", "sat"))
         elif o == "title": q = self.setstr(o, v)
         elif o == "trajcolors": q = self.settuple(o, v, self.setcolor)
         elif o == "trajlws": q = self.settuple(o, v, self.setfloat, 0)
@@ -734,6 +735,7 @@ nminorparallels\n\
 padding\n\
 parallelsbase\n\
 plotheight\n\
+regrid\n\
 trajcolors\n\
 title\n\
 trajlws\n\
@@ -1359,6 +1361,7 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
     title = None
     name = None
     elevation = None
+    layers = None
 
     # CloudSat.
     if filetype == "cloudsat-2b-geoprof":
@@ -1379,8 +1382,11 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
         if len(datasets) == 1:
             title = sdecode(datasets[0].attributes.get(b"long_name"))
             units = sdecode(datasets[0].attributes.get(b"units"))
+        # Read the next dataset in the background while the current one
+        # is being processed.
+        futures = [ds.prefetch() for ds in datasets]
         for (key, ds) in enumerate(datasets):
-            data = ds[::].astype('float32')
+            data = futures[key].result().astype('float32')
             if b"_FillValue" in ds.attributes:
                 data = np.ma.masked_equal(data, ds.attributes[b"_FillValue"])
             if b"missing" in ds.attributes:
@@ -1394,9 +1400,14 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
     # CALIPSO.
     if filetype in ("calipso-profile", "calipso-layer"):
         try:
-            time = product[b"Profile_UTC_Time"][:, 0]
-            lat = product[b"Latitude"][:, 0]
-            lon = product[b"Longitude"][:, 0]
+            geo = product.read_many({
+                b"Profile_UTC_Time": (slice(None), 0),
+                b"Latitude": (slice(None), 0),
+                b"Longitude": (slice(None), 0),
+            })
+            time = geo[b"Profile_UTC_Time"]
+            lat = geo[b"Latitude"]
+            lon = geo[b"Longitude"]
             datasets = [product[name] for name in info["datasets"]]
         except KeyError as e:
             fail("Field \"%s\" not found" % e.args)
@@ -1406,12 +1417,23 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
         if len(datasets) == 1:
             title = sdecode(info["datasets"][0]).replace("_", " ")
             units = datasets[0].attributes.get(b"units")
-        for (key, ds) in enumerate(datasets):
-            data = ds[::]
-            data = np.ma.masked_equal(data, -9999)
-            if b"fillvalue" in ds.attributes:
-                data = np.ma.masked_equal(data, ds.attributes[b"fillvalue"])
-            datasets[key] = data
+        if filetype == "calipso-layer":
+            # Only valid layers are read, with NaN in place of fill values.
+            try:
+                layers = ccplot.layers.read_layers(product, info["datasets"])
+            except KeyError as e:
+                fail("Field \"%s\" not found" % e.args)
+            except ValueError as e:
+                fail(str(e))
+            datasets = [layers[name] for name in info["datasets"]]
+        else:
+            futures = [ds.prefetch() for ds in datasets]
+            for (key, ds) in enumerate(datasets):
+                data = futures[key].result()
+                data = np.ma.masked_equal(data, -9999)
+                if b"fillvalue" in ds.attributes:
+                    data = np.ma.masked_equal(data, ds.attributes[b"fillvalue"])
+                datasets[key] = data
 
     # CALIPSO profile.
     if filetype == "calipso-profile":
@@ -1429,23 +1451,6 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
     # CALIPSO layer.
     if filetype == "calipso-layer":
         product_name = "CALIPSO Layer"
-        try:
-            topalt = product[b"Layer_Top_Altitude"]
-            basealt = product[b"Layer_Base_Altitude"]
-            nlayer = product[b"Number_Layers_Found"]
-        except KeyError as e:
-            fail("Field \"%s\" not found" % e.args)
-        topalt = np.ma.masked_equal(topalt[::], -9999)
-        basealt = np.ma.masked_equal(basealt[::], -9999)
-        try:
-            valid_range = nlayer.attributes[b"valid_range"]
-            try:
-                nbin = int(valid_range.split(b"...")[1])
-            except IndexError as ValueError:
-                warn("Invalid valid_range attribute \"%s\", assuming maximum number of layers 10" % valid_range)
-                nbin = 10  # Fall back to 10.
-        except KeyError:
-            nbin = 10  # Fall back to 10.
 
     # Override title and units if in info.
     if "title" in info:
@@ -1468,11 +1473,16 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
             ds *= 1.0/info["factor"]
         datasets[key] = ds
 
-    # Check size of datasets.
-    for ds in datasets:
-        if ds.shape != (nray, nbin):
-            fail("Dataset has shape %s, expected (%d, %d)" %
-                 (ds.shape, nray, nbin))
+    # Check size of datasets. Shapes of layer datasets are checked
+    # by read_layers.
+    if layers is not None:
+        if layers.nray != nray:
+            fail("Dataset has %d rays, expected %d" % (layers.nray, nray))
+    else:
+        for ds in datasets:
+            if ds.shape != (nray, nbin):
+                fail("Dataset has shape %s, expected (%d, %d)" %
+                     (ds.shape, nray, nbin))
 
     # Determine what time conversion function to apply. We need this now
     # in order to convert time extent (if set) to extent in rays.
@@ -1510,14 +1520,28 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
     if e1 >= e2: fail("Invalid extent")
 
     ve1, ve2 = vextent
+    ratio = what in ("calipso-cratio", "calipso-dratio")
 
     # Subsetting by extent.
     try:
-        if what in ("calipso-cratio", "calipso-dratio"):
-            data = datasets[1][e1:e2, e3:e4] / datasets[0][e1:e2, e3:e4]
+        if ratio:
+            # Numerator and denominator are regridded together and divided
+            # afterwards. Bins invalid in either of them are left out of
+            # both, so that both are averaged over the same bins.
+            num = datasets[1][e1:e2, e3:e4]
+            den = datasets[0][e1:e2, e3:e4]
+            invalid = np.ma.getmaskarray(num) | np.ma.getmaskarray(den)
+            num = np.ma.getdata(num)
+            den = np.ma.getdata(den)
+            invalid |= np.isnan(num) | np.isnan(den)
+            data = np.empty((2,) + num.shape, dtype=np.float32)
+            data[0] = np.where(invalid, np.nan, num)
+            data[1] = np.where(invalid, np.nan, den)
+            del num, den, invalid
         else:
             if filetype == "calipso-layer":
-                data = datasets[0][e1:e2, :]
+                layers = layers.subset(e1, e2)
+                data = layers[info["datasets"][0]]
             else:
                 data = datasets[0][e1:e2, e3:e4]
 
@@ -1529,13 +1553,10 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
         lat = lat[e1:e2]
 
         if filetype == "calipso-layer":
-            nlayer = nlayer[e1:e2, 0]
-            basealt = basealt[e1:e2, :]
-            topalt = topalt[e1:e2, :]
-            if not np.isfinite(ve1):
-                ve1 = np.min(basealt)*1000
-            if not np.isfinite(ve2):
-                ve2 = np.max(topalt)*1000
+            if not np.isfinite(ve1) and np.any(np.isfinite(layers.base)):
+                ve1 = np.nanmin(layers.base)*1000
+            if not np.isfinite(ve2) and np.any(np.isfinite(layers.top)):
+                ve2 = np.nanmax(layers.top)*1000
         else:
             if len(height.shape) == 2:
                 height = height[e1:e2, e3:e4]
@@ -1556,7 +1577,10 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
         fail("Invalid extent")
 
     if ve1 >= ve2: fail("Invalid vertical extent")
-    if norm == None: norm = mpl.colors.Normalize(data.min(), data.max())
+    if norm == None and not ratio:
+        # Layer data have NaN in place of fill values.
+        valid = np.ma.masked_invalid(data) if layers is not None else data
+        norm = mpl.colors.Normalize(valid.min(), valid.max())
 
     #
     # Core data processing and plotting.
@@ -1565,8 +1589,8 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
     if filetype == "calipso-layer":
         data = cctk.layermap(
             data,
-            nlayer.astype(np.uint8),
-            basealt, topalt,
+            layers.offsets,
+            layers.base, layers.top,
             (ve1*0.001, ve2*0.001, resolution),
             float("nan")
         )[:,::-1]
@@ -1580,7 +1604,7 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
         if radius == None: radius = int(PROFILE_BINHEIGHT*resolution/(ve2-ve1))
 
         # Currently, only float32 is supported by interpolation routines.
-        data = data.astype(np.float32)
+        if not ratio: data = data.astype(np.float32)
         X = X.astype(np.float32)
         Y = Y.astype(np.float32)
 
@@ -1591,10 +1615,37 @@ def plot_profile(what, fname, product, fig, axes, hextent=HorizontalExtent(),
         #     float("nan"), 0, radius
         # )
 
-        data = ccplot.algorithms.interp2d_12(data, X, Y,
-            e1, e2, e2 - e1,
-            ve2, ve1, resolution
-        )
+        plan_cache = os.getenv("CCPLOT_PLAN_CACHE")
+        if opts.regrid == "sat":
+            interp2d = ccplot.algorithms.interp2d_12_sat
+            interp2d_stack = ccplot.algorithms.interp2d_12_sat_stack
+        elif plan_cache:
+            # The mapping of bins to pixels is the same for all products
+            # with the same altitudes and extent.
+            plan = ccplot.algorithms.regrid_plan(X, Y,
+                e1, e2, e2 - e1,
+                ve2, ve1, resolution,
+                cache_dir=plan_cache
+            )
+            interp2d = interp2d_stack = lambda data, *args: plan.apply(data)
+        else:
+            interp2d = ccplot.algorithms.interp2d_12
+            interp2d_stack = ccplot.algorithms.interp2d_12_stack
+        if ratio:
+            data = interp2d_stack(data, X, Y,
+                e1, e2, e2 - e1,
+                ve2, ve1, resolution
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                data = data[0]/data[1]
+            if norm == None:
+                valid = np.ma.masked_invalid(data)
+                norm = mpl.colors.Normalize(valid.min(), valid.max())
+        else:
+            data = interp2d(data, X, Y,
+                e1, e2, e2 - e1,
+                ve2, ve1, resolution
+            )
     # Plot data.
     data = np.ma.masked_invalid(data)
     im = axes.imshow(data.T,
@@ -1718,15 +1769,24 @@ def plot_orbit(fnames, products, fig, axes,
         pass
     else: fail("Extent type not supported by swath plots")
 
-    # Search for a MODIS data file.
+    # Search for a MODIS data file. Only geolocation is read at this point.
+    # Data are read once the map is set up and the decimation factor
+    # can be determined.
+    modis_product = None
     modis_swath = None
     for fname, product in zip(fnames, products):
         info("Attempting to read MODIS swath from %s" % fname)
         if b"MODIS_SWATH_Type_L1B" in product:
+            modis_product = product
             modis_swath = read_modis_swath(product, band, band_mode,
-                                           along_track_ext, across_track_ext)
+                                           along_track_ext, across_track_ext,
+                                           read_data=False)
             break
 
+    # Read trajectories in the background while the map and the swath
+    # are being plotted.
+    trajectories = [prefetch_trajectory(product) for product in products]
+
     extent = None
     lon_0 = None
     lat_0 = None
@@ -1945,6 +2005,12 @@ def plot_orbit(fnames, products, fig, axes,
 
     # Plot swath.
     if modis_swath != None:
+        step = modis_swath_step(modis_swath, fig, axes) \
+            if radius is None else 1
+        info("Reading MODIS swath with step %d" % step)
+        modis_swath = read_modis_swath(modis_product, band, band_mode,
+                                       along_track_ext, across_track_ext,
+                                       step=step, geo=modis_swath)
         info("Plotting swath")
         plot_swath(modis_swath, fig, axes, proj, colormap=colormap, norm=norm,
                    ticks=ticks, radius=radius, opts=opts)
@@ -1954,26 +2020,28 @@ def plot_orbit(fnames, products, fig, axes,
 
     # Plot trajectories.
     j = 0
-    for product in products:
+    for fname, product, trajectory in zip(fnames, products, trajectories):
         if b"MODIS_SWATH_Type_L1B" in product: continue
         hit = False
+        satellite, future = trajectory
         try: # Try CALIPSO names.
-            time = product[b"Profile_UTC_Time"][:, 0]
-            lon = product[b"Longitude"][:, 0]
-            lat = product[b"Latitude"][:, 0]
+            if satellite != "CALIPSO": raise KeyError()
+            geo = future.result()
+            time = geo[b"Profile_UTC_Time"]
+            lon = geo[b"Longitude"]
+            lat = geo[b"Latitude"]
             time2dt = calipso_time2dt
-            satellite = "CALIPSO"
             hit = True
         except (KeyError, IndexError): pass
         try: # Try CloudSat names.
-            sw = product[b"2B-GEOPROF"]
-            time = sw[b"Profile_time"][:]
-            lon = sw[b"Longitude"][:]
-            lat = sw[b"Latitude"][:]
-            start_time = sw.attributes[b"start_time"]
+            if satellite != "CloudSat": raise KeyError()
+            geo = future.result()
+            time = geo[b"Profile_time"]
+            lon = geo[b"Longitude"]
+            lat = geo[b"Latitude"]
+            start_time = product[b"2B-GEOPROF"].attributes[b"start_time"]
             start_time_dt = dt.datetime.strptime(sdecode(start_time), "%Y%m%d%H%M%S")
             time2dt = lambda t: cloudsat_time2dt(t, start_time_dt)
-            satellite = "CloudSat"
             hit = True
         except (AttributeError, KeyError, IndexError): pass
 
@@ -1999,13 +2067,33 @@ def plot_orbit(fnames, products, fig, axes,
                             time_min.strftime("%Y-%m-%dT%H:%M:%SZ"),
                             time_max.strftime("%Y-%m-%dT%H:%M:%SZ"))]
             j = j+1
-        else: warn("%s: Unrecognized file, skipping" % fnames[i])
+        else: warn("%s: Unrecognized file, skipping" % fname)
 
     # Plot title.
     title = ", ".join(titlea)
     figure_title(fig, opts, title)
 
 
+def prefetch_trajectory(product):
+    """Schedule reading of time, longitude and latitude of a CALIPSO or
+    CloudSat product on a background reader thread. Returns a tuple of
+    satellite name and a future of a dictionary of the datasets, or
+    (None, None) if the product is not recognized."""
+    if b"Profile_UTC_Time" in product:
+        return "CALIPSO", product.prefetch({
+            b"Profile_UTC_Time": (slice(None), 0),
+            b"Longitude": (slice(None), 0),
+            b"Latitude": (slice(None), 0),
+        })
+    if b"2B-GEOPROF" in product:
+        return "CloudSat", product[b"2B-GEOPROF"].prefetch([
+            b"Profile_time",
+            b"Longitude",
+            b"Latitude",
+        ])
+    return None, None
+
+
 def plot_trajectory(fig, axes, lon, lat, time, time2dt,
     minorticks_base, majorticks_base, lw=1.0, color="#000000"):
 
@@ -2112,7 +2200,15 @@ def plot_trajectory(fig, axes, lon, lat, time, time2dt,
 
 
 def read_modis_swath(product, band, band_mode,
-                     along_track_ext=(0,-1), across_track_ext=(0,-1)):
+                     along_track_ext=(0,-1), across_track_ext=(0,-1),
+                     step=1, read_data=True, geo=None):
+    """Read MODIS swath band from product. Every step-th sample along
+    and across track is read. If read_data is False, only geolocation
+    is read and the data attribute of the returned swath is None.
+    geo is a swath read before from product with the same extents and
+    step 1 (such as with read_data=False), whose geolocation is decimated
+    instead of reading it again.
+    """
 
     sw = product[b"MODIS_SWATH_Type_L1B"]
 
@@ -2183,20 +2279,37 @@ def read_modis_swath(product, band, band_mode,
 
     if e1 >= e2 or e3 >= e4: return None
 
-    # Perform dimension mapping on lon/lat.
-    lat = ccplot.utils.dimmap(
-        ccplot.utils.dimmap(lat[:,:], e2 - e1, off1, inc1, 0, 360),
-        e4 - e3, off2, inc2, 1, 360
-    )
-    lon = ccplot.utils.dimmap(
-        ccplot.utils.dimmap(lon[:,:], e2 - e1, off1, inc1, 0, 360),
-        e4 - e3, off2, inc2, 1, 360
-    )
-    lon = (lon + 180.0) % 360.0 - 180.0
-    lat = (lat + 90.0) % 180.0 - 90.0
+    # Number of samples after decimation.
+    n1 = len(range(e1, e2, step))
+    n2 = len(range(e3, e4, step))
+
+    if geo is not None:
+        # Sample k of the decimated swath is sample k*step of geo.
+        lon = geo.lon[::step,::step]
+        lat = geo.lat[::step,::step]
+    else:
+        # Perform dimension mapping on lon/lat.
+        lat = ccplot.utils.dimmap(
+            ccplot.utils.dimmap(lat[:,:], n1, 1.0*off1/step, 1.0*inc1/step, 0, 360),
+            n2, 1.0*off2/step, 1.0*inc2/step, 1, 360
+        )
+        lon = ccplot.utils.dimmap(
+            ccplot.utils.dimmap(lon[:,:], n1, 1.0*off1/step, 1.0*inc1/step, 0, 360),
+            n2, 1.0*off2/step, 1.0*inc2/step, 1, 360
+        )
+        lon = (lon + 180.0) % 360.0 - 180.0
+        lat = (lat + 90.0) % 180.0 - 90.0
+
+    if not read_data:
+        swath = Swath()
+        swath.lon = lon
+        swath.lat = lat
+        swath.data = None
+        swath.step = step
+        return swath
 
     # Choose band and crop data.
-    data = data[band_index, e1:e2, e3:e4].astype(np.float32)
+    data = data[band_index, e1:e2:step, e3:e4:step].astype(np.float32)
     # Set invalid data elements to NaN.
     np.place(data, data < 0.0, float("nan"))
     # Peform dimension mapping.
@@ -2215,9 +2328,32 @@ def read_modis_swath(product, band, band_mode,
     swath.lat = lat
     swath.data = data
     swath.name = name
+    swath.step = step
     return swath
 
 
+def modis_swath_step(swath, fig, axes):
+    """Return the largest decimation factor of swath such that the distance
+    between samples does not exceed a pixel of axes."""
+    # Geolocation is smooth, so the distance is estimated on a coarser grid.
+    k = 10
+    res = axes.projection.transform_points(ccrs.PlateCarree(),
+        swath.lon[::k,::k], swath.lat[::k,::k])
+    x, y, width, height = get_axes_bounds(fig, axes)
+    x0, x1, y0, y1 = axes.get_extent()
+    X = res[:,:,0]*width*fig.get_dpi()/(x1 - x0)
+    Y = res[:,:,1]*height*fig.get_dpi()/(y1 - y0)
+    # Distance between adjacent samples in pixels along and across track.
+    d1 = np.hypot(np.diff(X, axis=0), np.diff(Y, axis=0))
+    d2 = np.hypot(np.diff(X, axis=1), np.diff(Y, axis=1))
+    d1 = d1[np.isfinite(d1)]
+    d2 = d2[np.isfinite(d2)]
+    if len(d1) == 0 or len(d2) == 0: return 1
+    d = max(np.median(d1), np.median(d2))/(k*swath.step)
+    if d <= 0: return 1
+    return max(1, int(1.0/d))
+
+
 def plot_swath(swath, fig, axes, proj, colormap=None, norm=None, ticks=None,
                radius=None, name=None, opts=PlotOpts()):
 
@@ -2241,17 +2377,18 @@ def plot_swath(swath, fig, axes, proj, colormap=None, norm=None, ticks=None,
             yfactor = 10018754.17/90.0
         else:
             xfactor = yfactor = 1.0
-        radius_x = int(EV_DATAPOINT_SIZE/((x1 - x0)*xfactor)*nx+0.5)
-        radius_y = int(EV_DATAPOINT_SIZE/((y1 - y0)*yfactor)*ny+0.5)
+        size = EV_DATAPOINT_SIZE*swath.step
+        radius_x = int(size/((x1 - x0)*xfactor)*nx+0.5)
+        radius_y = int(size/((y1 - y0)*yfactor)*ny+0.5)
         info("Interpolation radius: rx=%d, ry=%d" % (radius_x, radius_y))
     else:
         radius_x = radius_y = radius
     radius_x = max(1, radius_x)
     radius_y = max(1, radius_y)
 
-    data = cctk.interpolate2d(swath.data, X, Y, (x0, x1, nx),
-                              (y0, y1, ny), float("nan"),
-                              radius_x, radius_y)
+    data = cctk.nearest2d(swath.data, X, Y, (x0, x1, nx),
+                          (y0, y1, ny), float("nan"),
+                          radius_x, radius_y)
     del X, Y
 
     # Mask invalid values.
@@ -2280,21 +2417,12 @@ def main(argv):
 
     opts = parse_options(argv)
 
-    # Open each file as HDF and HDF-EOS if possible.
+    # Open each file as HDF-EOS if possible, or HDF otherwise.
     products = []
     for fname in opts.fnames:
-        try: product = HDF(fsencode(fname))
+        try: product = ccplot.open(fsencode(fname),
+            shared_cache=bool(os.getenv("CCPLOT_SHARED_CACHE")))
         except IOError as e: fail("%s: %s" % (fname, e.strerror))
-
-        try: hdfeosversion = product.attributes[b'HDFEOSVersion']
-        except KeyError: hdfeosversion = None
-
-        if hdfeosversion is not None:
-            # Reopen with HDFEOS.
-            product.close()
-            try: product = HDFEOS(fsencode(fname))
-            except IOError as e: fail("%s: %s" % (fname, e.strerror))
-
         products.append(product)
 
     if opts.print_info_only:
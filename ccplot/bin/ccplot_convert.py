@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# ccplot-convert
+# This file is a part of ccplot: CloudSat and CALIPSO plotting tool.
+#
+# Copyright (c) 2009-2026 Peter Kuma
+#
+# This software is provided under the terms of a 2-clause BSD licence:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice,
+#      this list of conditions and the following disclaimer.
+#   2. Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer
+#      in the documentation and/or other materials provided with
+#      the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE CCPLOT PROJECT ``AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+# IN NO EVENT SHALL THE CCPLOT PROJECT OR CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED
+# AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE
+# USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import sys
+import getopt
+
+import ccplot
+import ccplot.store
+
+program_name = os.path.basename(sys.argv[0])
+
+
+def fail(s):
+    sys.stderr.write("%s: %s\n" % (program_name, s))
+    sys.exit(1)
+
+
+def warn(s):
+    sys.stderr.write("%s: Warning: %s\n" % (program_name, s))
+
+
+def usage():
+    """Prints usage information and exits the program with return value of 1."""
+    sys.stderr.write("Usage: %s [-s SIZE] FILE [OUTPUT]\n" % program_name)
+    sys.stderr.write("Try `%s -h' for more information.\n" % program_name)
+    sys.exit(1)
+
+
+def help_and_exit():
+    """Prints help and exits the program with return value of 0."""
+    print("""Usage: %s [-s SIZE] FILE [OUTPUT]
+
+Convert an HDF4 or HDF-EOS2 product FILE to a ccplot store, a directory
+of raw, chunked .npy files and a JSON manifest, which ccplot can open in
+place of FILE. The store is written to OUTPUT, or FILE.ccplot if omitted.
+
+Options:
+  -s SIZE   target chunk size in MiB (default: %d)
+  -h        show this help and exit""" % (
+        program_name,
+        ccplot.store.CHUNK_SIZE//(1024*1024)
+    ))
+    sys.exit(0)
+
+
+def main(argv):
+    if len(argv) == 2 and argv[1] == "-h": help_and_exit()
+
+    try: cmdopts, args = getopt.getopt(argv[1:], "s:")
+    except getopt.error: usage()
+
+    chunk_size = ccplot.store.CHUNK_SIZE
+    for o, a in cmdopts:
+        if o == "-s":
+            try:
+                chunk_size = int(float(a)*1024*1024)
+                if chunk_size <= 0: raise ValueError
+            except ValueError:
+                fail("Invalid argument passed to %s" % o)
+
+    if len(args) not in (1, 2): usage()
+    fname = args[0]
+    output = args[1] if len(args) == 2 else fname + ".ccplot"
+
+    try: product = ccplot.open(os.fsencode(fname))
+    except IOError as e: fail("%s: %s" % (fname, e.strerror))
+    if isinstance(product, ccplot.store.Store):
+        fail("%s: File is already a ccplot store" % fname)
+    try:
+        skipped = ccplot.store.convert(product, output, chunk_size)
+    except IOError as e:
+        fail("%s: %s" % (output, e.strerror))
+    finally:
+        product.close()
+    for name in skipped:
+        warn("%s: Unsupported data type, skipped" % os.fsdecode(name))
+
+
+def main_wrapper():
+    try:
+        main(sys.argv)
+    except MemoryError:
+        fail("Insufficient memory")
+
+
+if __name__ == "__main__":
+    main_wrapper()
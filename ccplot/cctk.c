@@ -33,6 +33,10 @@
 #include <numpy/arrayobject.h>
 #include <numpy/npy_math.h>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 #define lroundf(x) ((long)((x) >= 0 ? (x)+0.5 : (x)-0.5))
 
 static void
@@ -313,6 +317,295 @@ fail:
 	return NULL;
 }
 
+/*
+ * Nearest-neighbour regridding of swath data by a spatial hash.
+ *
+ * Gives the same result as interpolate2d: every output cell is assigned
+ * the value of the nearest valid input point which is not further than
+ * radiusx and radiusy cells away from it (along the respective axis,
+ * rounded to the nearest cell). Instead of splatting every input point
+ * over a window of (2*radiusx+1) x (2*radiusy+1) cells, input points are
+ * sorted into buckets of the output grid (extended by the radius on every
+ * side), and every output cell searches the buckets in rings of increasing
+ * distance, stopping as soon as no closer point can be found. A summed-area
+ * table of the number of points in buckets is used to skip empty rings and
+ * to stop when no points are left within the radius, so that output cells
+ * in gaps of the swath are not searched. The cost is proportional to the
+ * number of input points plus the number of output cells for densely
+ * sampled swaths, and memory is proportional to the same. Output rows are
+ * processed in parallel by threads threads (all processors if 0) if
+ * compiled with OpenMP.
+ */
+
+struct nearest2d_point {
+	npy_float kf, lf;
+	npy_float value;
+	npy_intp index;
+};
+
+/* Number of points in buckets [k1, k2] x [l1, l2] of the summed-area table
+ * sat of gyn + 1 columns. */
+static npy_intp
+nearest2d_count(const npy_intp *sat, npy_intp gyn, npy_intp k1, npy_intp k2,
+	npy_intp l1, npy_intp l2)
+{
+	return sat[(k2 + 1)*(gyn + 1) + l2 + 1] - sat[k1*(gyn + 1) + l2 + 1] -
+		sat[(k2 + 1)*(gyn + 1) + l1] + sat[k1*(gyn + 1) + l1];
+}
+
+static int
+nearest2d(
+    PyArrayObject *data, PyArrayObject *xin2d, PyArrayObject *yin2d,
+    PyArrayObject *out,
+	float xout1, float xout2, float yout1, float yout2,
+	float fill, int radiusx, int radiusy, int threads)
+{
+	npy_intp i, j, k, l, n, b;
+	npy_intp xdim, ydim, xoutn, youtn;
+	npy_intp gxn, gyn, npoints;
+	npy_intp *offset = NULL, *next = NULL, *sat = NULL;
+	struct nearest2d_point *points = NULL;
+	npy_float x, y, v;
+	float kf, lf;
+
+	xdim = PyArray_DIMS(data)[0];
+	ydim = PyArray_DIMS(data)[1];
+	xoutn = PyArray_DIMS(out)[0];
+	youtn = PyArray_DIMS(out)[1];
+
+	/* Buckets cover the output grid and cells up to the radius outside. */
+	gxn = xoutn + 2*(npy_intp)radiusx;
+	gyn = youtn + 2*(npy_intp)radiusy;
+
+	offset = calloc(gxn*gyn + 1, sizeof(npy_intp));
+	if (offset == NULL) goto fail;
+
+	/* Count points in buckets. */
+	npoints = 0;
+	for (i = 0; i < xdim; i++) {
+		for (j = 0; j < ydim; j++) {
+			v = *((npy_float *) PyArray_GETPTR2(data, i, j));
+			if (npy_isnan(v)) continue;
+			x = *((npy_float *) PyArray_GETPTR2(xin2d, i, j));
+			y = *((npy_float *) PyArray_GETPTR2(yin2d, i, j));
+			kf = (x - xout1) / (xout2 - xout1) * xoutn;
+			lf = (y - yout1) / (yout2 - yout1) * youtn;
+			/* Also excludes NaN coordinates. */
+			if (!(kf > -radiusx - 1 && kf < xoutn + radiusx &&
+				lf > -radiusy - 1 && lf < youtn + radiusy))
+				continue;
+			k = lroundf(kf) + radiusx;
+			l = lroundf(lf) + radiusy;
+			if (k < 0 || l < 0 || k >= gxn || l >= gyn) continue;
+			offset[k*gyn + l + 1]++;
+			npoints++;
+		}
+	}
+	for (b = 0; b < gxn*gyn; b++)
+		offset[b + 1] += offset[b];
+
+	points = malloc((npoints > 0 ? npoints : 1)*sizeof(*points));
+	next = malloc(gxn*gyn*sizeof(npy_intp));
+	if (points == NULL || next == NULL) goto fail;
+	memcpy(next, offset, gxn*gyn*sizeof(npy_intp));
+
+	/* Sort points into buckets, in the order of input. */
+	for (i = 0; i < xdim; i++) {
+		for (j = 0; j < ydim; j++) {
+			v = *((npy_float *) PyArray_GETPTR2(data, i, j));
+			if (npy_isnan(v)) continue;
+			x = *((npy_float *) PyArray_GETPTR2(xin2d, i, j));
+			y = *((npy_float *) PyArray_GETPTR2(yin2d, i, j));
+			kf = (x - xout1) / (xout2 - xout1) * xoutn;
+			lf = (y - yout1) / (yout2 - yout1) * youtn;
+			if (!(kf > -radiusx - 1 && kf < xoutn + radiusx &&
+				lf > -radiusy - 1 && lf < youtn + radiusy))
+				continue;
+			k = lroundf(kf) + radiusx;
+			l = lroundf(lf) + radiusy;
+			if (k < 0 || l < 0 || k >= gxn || l >= gyn) continue;
+			n = next[k*gyn + l]++;
+			points[n].kf = kf;
+			points[n].lf = lf;
+			points[n].value = v;
+			points[n].index = i*ydim + j;
+		}
+	}
+	free(next);
+	next = NULL;
+
+	/* sat[k*(gyn + 1) + l] is the number of points in buckets
+	 * [0, k) x [0, l). */
+	sat = calloc((gxn + 1)*(gyn + 1), sizeof(npy_intp));
+	if (sat == NULL) goto fail;
+	for (k = 0; k < gxn; k++) {
+		n = 0;
+		for (l = 0; l < gyn; l++) {
+			b = k*gyn + l;
+			n += offset[b + 1] - offset[b];
+			sat[(k + 1)*(gyn + 1) + l + 1] =
+				sat[k*(gyn + 1) + l + 1] + n;
+		}
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+#ifdef _OPENMP
+	if (threads <= 0) threads = omp_get_max_threads();
+	#pragma omp parallel for num_threads(threads) schedule(dynamic, 1) \
+		private(j)
+#endif
+	for (i = 0; i < xoutn; i++) {
+		for (j = 0; j < youtn; j++) {
+			npy_intp p, q, d, dmax, qstep, m, c, dx, dy;
+			npy_intp inner = 0, outer, ring;
+			npy_intp best_index = -1;
+			float best = 0.f, coef;
+			npy_float value = fill;
+
+			/* Buckets within the radius of cell (i, j) are
+			 * [i, i + 2*radiusx] x [j, j + 2*radiusy]. */
+			outer = nearest2d_count(sat, gyn, i, i + 2*radiusx,
+				j, j + 2*radiusy);
+			dmax = radiusx > radiusy ? radiusx : radiusy;
+			for (d = 0; d <= dmax; d++) {
+				/* Points in ring d are at least d - 0.5 cells
+				 * away. */
+				if (best_index >= 0 &&
+					(d - 0.5f)*(d - 0.5f) > best)
+					break;
+				/* No points left in rings d and beyond. */
+				if (outer == inner) break;
+				dx = d < radiusx ? d : radiusx;
+				dy = d < radiusy ? d : radiusy;
+				ring = nearest2d_count(sat, gyn,
+					i + radiusx - dx, i + radiusx + dx,
+					j + radiusy - dy, j + radiusy + dy) - inner;
+				inner += ring;
+				if (ring == 0) continue;
+				for (p = -d; p <= d; p++) {
+					if (p < -radiusx || p > radiusx) continue;
+					/* Whole column on the edge of the ring,
+					 * otherwise only its two ends. */
+					qstep = (p == -d || p == d) ? 1 : 2*d;
+					for (q = -d; q <= d; q += qstep) {
+						if (q < -radiusy || q > radiusy)
+							continue;
+						c = (i + p + radiusx)*gyn +
+							j + q + radiusy;
+						for (m = offset[c]; m < offset[c + 1]; m++) {
+							coef = (i-points[m].kf)*(i-points[m].kf) +
+								(j-points[m].lf)*(j-points[m].lf);
+							if (best_index < 0 || coef < best ||
+								(coef == best &&
+								points[m].index < best_index)) {
+								best = coef;
+								best_index = points[m].index;
+								value = points[m].value;
+							}
+						}
+					}
+				}
+			}
+			*((npy_float *) PyArray_GETPTR2(out, i, j)) = value;
+		}
+	}
+	Py_END_ALLOW_THREADS
+
+	free(sat);
+	free(points);
+	free(offset);
+	return 0;
+fail:
+	free(sat);
+	free(next);
+	free(points);
+	free(offset);
+	PyErr_NoMemory();
+	return -1;
+}
+
+static PyObject *
+cctk_nearest2d(PyObject *self, PyObject *args)
+{
+	PyObject *arg1 = NULL, *arg2 = NULL, *arg3 = NULL;
+	PyArrayObject *data = NULL, *xin2d = NULL, *yin2d = NULL;
+	float xout1, xout2, yout1, yout2;
+	int xoutn, youtn;
+	PyArrayObject *out = NULL;
+	float fill;
+	int radiusx, radiusy;
+	int threads = 0;
+
+	npy_intp *dims1 = NULL, *dims2 = NULL, *dims3 = NULL;
+	npy_intp outdims[2] = { 0, 0 };
+
+	if (!PyArg_ParseTuple(args, "OOO(ffi)(ffi)fii|i", &arg1, &arg2, &arg3,
+		&xout1, &xout2, &xoutn, &yout1, &yout2, &youtn, &fill,
+		&radiusx, &radiusy, &threads)) {
+		return NULL;
+	}
+
+	data = (PyArrayObject *) \
+	    PyArray_FROM_OTF(arg1, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
+	if (data == NULL) goto fail;
+
+	xin2d = (PyArrayObject *) \
+	    PyArray_FROM_OTF(arg2, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
+	if (xin2d == NULL) goto fail;
+
+	yin2d = (PyArrayObject *) \
+	    PyArray_FROM_OTF(arg3, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
+	if (yin2d == NULL) goto fail;
+
+	if (PyArray_NDIM(data) != 2 || PyArray_NDIM(xin2d) != 2 ||
+		PyArray_NDIM(yin2d) != 2) {
+		PyErr_SetString(PyExc_ValueError, "Incorrect dimensions.");
+		goto fail;
+	}
+
+	dims1 = PyArray_DIMS(data);
+	dims2 = PyArray_DIMS(xin2d);
+	dims3 = PyArray_DIMS(yin2d);
+
+	if (dims2[0] != dims1[0] || dims2[1] != dims1[1] ||
+		dims3[0] != dims1[0] || dims3[1] != dims1[1]) {
+		PyErr_SetString(PyExc_ValueError, "Dimensions do not match");
+		goto fail;
+	}
+
+	if (radiusx < 0 || radiusy < 0) {
+		PyErr_SetString(PyExc_ValueError, "Negative radius");
+		goto fail;
+	}
+
+	outdims[0] = xoutn;
+	outdims[1] = youtn;
+
+	if (outdims[0] < 0 || outdims[1] < 0) {
+		PyErr_SetString(PyExc_ValueError, "Negative output size");
+		goto fail;
+	}
+
+	out = (PyArrayObject *) PyArray_ZEROS(2, outdims, NPY_FLOAT, 0);
+	if (out == NULL) goto fail;
+
+	/* Core function call. */
+	if (nearest2d(data, xin2d, yin2d, out, xout1, xout2, yout1, yout2,
+		fill, radiusx, radiusy, threads) != 0)
+		goto fail;
+
+	Py_DECREF(data);
+	Py_DECREF(xin2d);
+	Py_DECREF(yin2d);
+	return (PyObject *) out;
+fail:
+	Py_XDECREF(data);
+	Py_XDECREF(xin2d);
+	Py_XDECREF(yin2d);
+	Py_XDECREF(out);
+	return NULL;
+}
+
 /*
  * Performs mapping of CALIPSO layer data onto a regular grid.
  *
@@ -384,6 +677,141 @@ layermap(PyArrayObject *data, PyArrayObject *nlayer, PyArrayObject *basealt,
 	return (PyObject *) out;
 }
 
+/*
+ * Performs mapping of packed CALIPSO layer data onto a regular grid.
+ *
+ * The same as layermap, but data, basealt and topalt are 1D numpy float
+ * arrays of valid layers only, and layers of ray i are at offsets[i] to
+ * offsets[i+1] (see ccplot.layers). Rays are processed in parallel by
+ * threads threads (all processors if 0) if compiled with OpenMP.
+ */
+static void
+layermap_packed(PyArrayObject *data, PyArrayObject *offsets,
+	PyArrayObject *basealt, PyArrayObject *topalt, PyArrayObject *out,
+	float y0, float ym, float fill, int threads)
+{
+	npy_intp i, n, m;
+	npy_float alt2y_ratio;
+	npy_float *d, *b, *t;
+	npy_intp *o;
+
+	n = PyArray_DIMS(out)[0];
+	m = PyArray_DIMS(out)[1];
+	d = PyArray_DATA(data);
+	b = PyArray_DATA(basealt);
+	t = PyArray_DATA(topalt);
+	o = PyArray_DATA(offsets);
+
+	alt2y_ratio = m/(ym - y0);
+
+	Py_BEGIN_ALLOW_THREADS
+#ifdef _OPENMP
+	if (threads <= 0) threads = omp_get_max_threads();
+	#pragma omp parallel for num_threads(threads) schedule(static)
+#endif
+	for (i = 0; i < n; i++) {
+		npy_intp j, k, p, q;
+		npy_float pf, qf;
+		npy_float *outrow = PyArray_GETPTR2(out, i, 0);
+
+		for (k = 0; k < m; k++)
+			outrow[k] = fill;
+
+		for (j = o[i]; j < o[i+1]; j++) {
+			pf = (b[j] - y0) * alt2y_ratio;
+			qf = (t[j] - y0) * alt2y_ratio;
+			if (npy_isnan(pf) || npy_isnan(qf)) continue;
+			p = lroundf(pf);
+			q = lroundf(qf);
+			if (p < 0) p = 0;
+			if (q > m) q = m;
+			for (k = p; k < q; k++)
+				outrow[k] = d[j];
+		}
+	}
+	Py_END_ALLOW_THREADS
+}
+
+static PyObject *
+cctk_layermap_packed(PyObject *arg1, PyObject *arg2, PyObject *arg3,
+	PyObject *arg4, float yout1, float yout2, int youtn, float fill,
+	int threads)
+{
+	PyArrayObject *data = NULL, *offsets = NULL, *basealt = NULL;
+	PyArrayObject *topalt = NULL, *out = NULL;
+	npy_intp i, nray, nlayers;
+	npy_intp *o;
+	npy_intp outdims[2] = { 0, 0 };
+
+	data = (PyArrayObject *) \
+	    PyArray_FROM_OTF(arg1, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
+	if (data == NULL) goto fail;
+
+	offsets = (PyArrayObject *) \
+	    PyArray_FROM_OTF(arg2, NPY_INTP, NPY_ARRAY_IN_ARRAY);
+	if (offsets == NULL) goto fail;
+
+	basealt = (PyArrayObject *) \
+	    PyArray_FROM_OTF(arg3, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
+	if (basealt == NULL) goto fail;
+
+	topalt = (PyArrayObject *) \
+	    PyArray_FROM_OTF(arg4, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
+	if (topalt == NULL) goto fail;
+
+	if (PyArray_NDIM(data) != 1 || PyArray_NDIM(offsets) != 1 ||
+		PyArray_NDIM(basealt) != 1 || PyArray_NDIM(topalt) != 1 ||
+		PyArray_DIMS(offsets)[0] < 1) {
+		PyErr_SetString(PyExc_ValueError, "Incorrect dimensions.");
+		goto fail;
+	}
+
+	nray = PyArray_DIMS(offsets)[0] - 1;
+	nlayers = PyArray_DIMS(data)[0];
+
+	if (PyArray_DIMS(basealt)[0] != nlayers ||
+		PyArray_DIMS(topalt)[0] != nlayers) {
+		PyErr_SetString(PyExc_ValueError, "Dimensions do not match");
+		goto fail;
+	}
+
+	o = PyArray_DATA(offsets);
+	for (i = 0; i < nray; i++) {
+		if (o[i] < 0 || o[i] > o[i+1] || o[i+1] > nlayers) {
+			PyErr_SetString(PyExc_ValueError, "Invalid offsets");
+			goto fail;
+		}
+	}
+
+	outdims[0] = nray;
+	outdims[1] = youtn;
+
+	if (outdims[1] < 0) {
+		PyErr_SetString(PyExc_ValueError, "Negative output size");
+		goto fail;
+	}
+
+	out = (PyArrayObject *) PyArray_ZEROS(2, outdims, NPY_FLOAT, 0);
+	if (out == NULL) goto fail;
+
+	/* Core function call. */
+	layermap_packed(data, offsets, basealt, topalt, out, yout1, yout2, fill,
+		threads);
+
+	Py_DECREF(data);
+	Py_DECREF(offsets);
+	Py_DECREF(basealt);
+	Py_DECREF(topalt);
+	return (PyObject *) out;
+fail:
+	Py_XDECREF(data);
+	Py_XDECREF(offsets);
+	Py_XDECREF(basealt);
+	Py_XDECREF(topalt);
+	Py_XDECREF(out);
+	return NULL;
+}
+
 static PyObject *
 cctk_layermap(PyObject *self, PyObject *args)
 {
@@ -393,15 +821,21 @@ cctk_layermap(PyObject *self, PyObject *args)
 	float yout1, yout2;
 	int youtn;
 	float fill;
+	int threads = 0;
 
 	npy_intp *dims1 = NULL, *dims2 = NULL, *dims3 = NULL, *dims4 = NULL;
 	npy_intp outdims[2] = { 0, 0 };
 
-	if (!PyArg_ParseTuple(args, "OOOO(ffi)f", &arg1, &arg2, &arg3, &arg4,
-		&yout1, &yout2, &youtn, &fill)) {
+	if (!PyArg_ParseTuple(args, "OOOO(ffi)f|i", &arg1, &arg2, &arg3, &arg4,
+		&yout1, &yout2, &youtn, &fill, &threads)) {
 		return NULL;
 	}
 
+	/* Packed layers (one-dimensional data and offsets). */
+	if (PyArray_Check(arg1) && PyArray_NDIM((PyArrayObject *) arg1) == 1)
+		return cctk_layermap_packed(arg1, arg2, arg3, arg4, yout1, yout2,
+			youtn, fill, threads);
+
 	data = (PyArrayObject *) \
 	    PyArray_FROM_OTF(arg1, NPY_FLOAT, NPY_ARRAY_IN_ARRAY);
 	if (data == NULL) goto fail;
@@ -468,10 +902,13 @@ fail:
 static PyMethodDef cctk_methods[] = {
 	{ "interpolate2d", cctk_interpolate2d, METH_VARARGS,
 		"Linearly interpolate values of a 2D array on a regular grid."},
+	{ "nearest2d", cctk_nearest2d, METH_VARARGS,
+		"Map values of a 2D array onto a regular grid by nearest neighbour." },
 	{ "dimmap2d", cctk_dimmap2d, METH_VARARGS,
 		"Map dimensions by linear interpolation." },
 	{ "layermap", cctk_layermap, METH_VARARGS,
-		"Map a layer product onto a two-dimensional regular grid." },
+		"Map a layer product (dense or packed) onto a two-dimensional "
+		"regular grid." },
 	{NULL, NULL}
 };
 
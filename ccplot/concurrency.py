@@ -0,0 +1,64 @@
+"""Concurrency model of ccplot.hdf and ccplot.hdfeos.
+
+libmfhdf and libhdfeos are not thread-safe. All calls into the libraries
+are serialised by a single process-wide reentrant lock, hdf_lock, which is
+held only for the duration of the library calls. Reading of data releases
+the GIL (but not hdf_lock), so that other threads can do non-HDF work,
+such as regridding, while a read is in progress. Only one thread reads from
+HDF files at a time; there is no benefit in using more than one reader
+thread.
+
+Reads can be run on a pool of reader threads with Dataset.read_async, which
+returns an awaitable for use with asyncio, or with the functions below.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+hdf_lock = threading.RLock()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def locked(f):
+    """Decorator which holds hdf_lock for the duration of the call."""
+    @functools.wraps(f)
+    def g(*args, **kwargs):
+        with hdf_lock:
+            return f(*args, **kwargs)
+    return g
+
+def reader_pool():
+    """Return the default pool of reader threads (created on first use)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix='ccplot-reader'
+            )
+        return _pool
+
+def set_reader_pool(executor):
+    """Set the default pool of reader threads to executor, an instance of
+    concurrent.futures.Executor. Returns the previous pool or None."""
+    global _pool
+    with _pool_lock:
+        prev = _pool
+        _pool = executor
+        return prev
+
+def submit(f, *args, executor=None):
+    """Call f(*args) on executor (the default reader pool if None). Returns
+    an instance of concurrent.futures.Future."""
+    if executor is None: executor = reader_pool()
+    return executor.submit(f, *args)
+
+async def run_async(f, *args, executor=None):
+    """Call f(*args) on executor (the default reader pool if None) without
+    blocking the running event loop and return the result."""
+    if executor is None: executor = reader_pool()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(f, *args))
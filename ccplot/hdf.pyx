@@ -2,8 +2,11 @@ cimport cython
 cimport numpy as np
 import sys
 import os
+import itertools
 import numpy as np
+from collections import OrderedDict
 from .autostr import autostr, Autostr
+from .concurrency import hdf_lock, locked, run_async, submit
 
 if sys.version_info[0] == 2:
     from UserDict import DictMixin as DictMixin
@@ -44,25 +47,39 @@ cdef extern from "mfhdf.h":
         FIELDNAMELENMAX = 128
         VSNAMELENMAX = 64
         FULL_INTERLACE = 0
+        HDF_NONE = 0
+        HDF_CHUNK = 1
+
+    ctypedef enum comp_coder_t:
+        COMP_CODE_NONE = 0
 
     ctypedef np.npy_uint8 uint8
     ctypedef np.npy_int8 int8
     ctypedef np.npy_int16 int16
     ctypedef np.npy_int32 int32
     ctypedef int intn
+    ctypedef unsigned int uintn
     ctypedef int hdf_err_code_t
 
+    ctypedef union HDF_CHUNK_DEF:
+        int32 chunk_lengths[H4_MAX_VAR_DIMS]
+
     int32 SDstart(char *, int32)
     int32 SDnametoindex(int32, char *)
     int32 SDselect(int32, int32)
     intn SDgetinfo(int32, char *, int32 *, int32 [], int32 *, int32 *)
-    intn SDreaddata(int32, int32 *, int32 *, int32 *, void *)
+    intn SDreaddata(int32, int32 *, int32 *, int32 *, void *) nogil
     intn SDendaccess(int32)
     intn SDend(int32)
     intn SDattrinfo(int32, int32, char *, int32 *, int32 *)
     intn SDreadattr(int32, int32, void *)
     int32 SDfindattr(int32, char *)
     intn SDfileinfo(int32, int32 *, int32 *)
+    intn SDgetcomptype(int32, comp_coder_t *)
+    intn SDgetchunkinfo(int32, HDF_CHUNK_DEF *, int32 *)
+    intn SDreadchunk(int32, int32 *, void *) nogil
+    intn SDgetdatainfo(int32, int32 *, uintn, uintn, int32 *, int32 *)
+    intn SDgetexternalinfo(int32, uintn, char *, int32 *, int32 *)
     int16 HEvalue(int32)
     char *HEstring(hdf_err_code_t)
 
@@ -75,7 +92,8 @@ cdef extern from "mfhdf.h":
     intn VSinquire(int32, int32 *, int32 *, char *, int32 *, char *)
     int32 VSfind(int32, char *)
     intn VSsetfields(int32, char *)
-    int32 VSread(int32, uint8 *, int32, int32)
+    int32 VSread(int32, uint8 *, int32, int32) nogil
+    int32 VSseek(int32, int32)
     int32 VSgetname(int32, char *)
     int32 VSgetid(int32, int32)
     int32 VSgetclass(int32, char *)
@@ -105,20 +123,103 @@ DTYPE = {
     DFNT_UINT64: np.uint64,
 }
 
+# Maximum number of SDS kept selected per file by HDF.
+SDS_CACHE_SIZE = 64
+
+# Maximum size in bytes of decompressed chunks cached per file by HDF.
+CHUNK_CACHE_SIZE = 64*1024*1024
+
+
+def _hyperslab(key, shape):
+    """Convert key to a hyperslab of an array of shape. Returns a tuple
+    (start, edges, stride, dims), where dims is a boolean array of
+    the dimensions retained in the result."""
+    rank = len(shape)
+    starta = np.zeros(rank, dtype=np.int32)
+    edgesa = shape.copy()
+    stridea = np.ones(rank, dtype=np.int32)
+
+    if type(key) != tuple:
+        key = (key,)
+
+    if len(key) > rank:
+        raise IndexError('too many indices')
+
+    dims = np.ones(rank, dtype=bool)
+    for i, s, n in zip(range(rank), key, shape):
+        if type(s) != slice:
+            if s < 0: s += n
+            if s < 0 or s >= n: raise IndexError('index out of bounds')
+            starta[i] = s
+            edgesa[i] = 1
+            dims[i] = False
+        else:
+            start, stop, step = s.start, s.stop, s.step
+            if step is None: step = 1
+            if step <= 0: raise IndexError('negative stride not supported')
+            if start is None: start = 0
+            if stop is None: stop = n
+            if start < 0: start += n
+            if stop < 0: stop += n
+            start = min(max(0, n-1), max(0, start))
+            stop = min(n, max(0, stop))
+            starta[i] = start
+            edgesa[i] = max(0, (stop - start + step - 1)//step)
+            stridea[i] = step
+    return starta, edgesa, stridea, dims
+
+
+def _slices(start, edges, stride):
+    """Convert a hyperslab to a tuple of slices."""
+    return tuple(slice(s, s + (e - 1)*st + 1 if e > 0 else s, st)
+        for s, e, st in zip(start, edges, stride))
+
+
+def _squeeze(data, dims):
+    shape = []
+    for n, d in zip(data.shape, dims):
+        if d: shape.append(n)
+    if len(shape) == 0: return data.ravel()[0]
+    else: return data.reshape(shape)
+
 
 class Attributes(DictMixin, Autostr):
     @autostr
     def __init__(self, hdf, dataset=None):
         self.hdf = hdf
         self.dataset = dataset
+        self._snapshot = None
+
+    def __reduce__(self):
+        return (Attributes, (self.hdf, self.dataset))
+
+    def _load(self):
+        if self._snapshot is None:
+            self._snapshot = self.hdf._readattrs(self.dataset)
+        return self._snapshot
+
+    @autostr
+    def load_all(self):
+        """Read all attributes in one pass and return them as a dictionary.
+        Attributes are then looked up in this snapshot without further
+        library calls. Attributes of unsupported data types are omitted."""
+        return {k: v for k, v in self._load().items()
+            if not isinstance(v, NotImplementedError)}
 
     @autostr
     def __getitem__(self, key):
-        return self.hdf._readattr(self.dataset, key)
+        try: value = self._load()[key]
+        except KeyError: raise KeyError(self._autostr(key))
+        if isinstance(value, NotImplementedError): raise value
+        return value
+
+    @autostr
+    def __contains__(self, key):
+        return key in self._load()
 
     @autostr
     def keys(self):
-        return self.hdf._attributes(self.dataset)
+        return list(self._load().keys())
 
 
 class Dataset(Autostr):
@@ -129,46 +230,83 @@ class Dataset(Autostr):
         info = self.hdf._getinfo(name)
         self.shape = info['shape']
         self.rank = len(self.shape)
+        self.ndim = self.rank
+        self.dtype = np.dtype(info['dtype'])
         self.attributes = Attributes(self.hdf, name)
 
+    def __reduce__(self):
+        # Pickled as a reference to the dataset in the file.
+        return (Dataset, (self.hdf, self.name))
+
+    @property
+    def chunks(self):
+        """Tuple of chunk lengths of the dataset in the file, or None if
+        the dataset is not chunked."""
+        return self.hdf._chunks(self.name)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        if dtype is not None: data = data.astype(dtype, copy=False)
+        return data
+
     @autostr
     def __getitem__(self, key):
-        starta = np.zeros(self.rank, dtype=np.int32)
-        edgesa = self.shape.copy()
+        starta, edgesa, stridea, dims = _hyperslab(key, self.shape)
+        data = self.hdf._read(self.name, starta, edgesa, stridea)
+        return _squeeze(data, dims)
 
-        if type(key) != tuple:
-            key = (key,)
+    @autostr
+    def read_into(self, out, key=slice(None)):
+        """Read the part of the dataset selected by key into out and return
+        out. out must be a writeable C-contiguous array of dtype of
+        the dataset and of the shape which ds[key] would return."""
+        if not isinstance(out, np.ndarray) or out.dtype != self.dtype:
+            raise ValueError('out must be an array of dtype %s' % self.dtype)
+        starta, edgesa, stridea, dims = _hyperslab(key, self.shape)
+        shape = tuple(edgesa[dims])
+        if out.shape != shape:
+            raise ValueError('out has shape %s, expected %s' % (out.shape, shape))
+        if not out.flags.c_contiguous or not out.flags.writeable:
+            raise ValueError('out must be a writeable C-contiguous array')
+        self.hdf._read(self.name, starta, edgesa, stridea, out=out)
+        return out
 
-        if len(key) > self.rank:
-            raise IndexError('too many indices')
+    def memmap(self):
+        """Return a read-only memory-mapped array of the whole dataset if
+        it is stored uncompressed and contiguously in the file, or None
+        otherwise. The array is in the byte order of the file (big-endian).
+        No data are read until accessed."""
+        return self.hdf._memmap(self.name)
 
-        dims = np.ones(self.rank, dtype=bool)
-        for i, s, n in zip(range(self.rank), key, self.shape):
-            if type(s) != slice:
-                if s < 0: s += n
-                if s < 0 or s >= n: raise IndexError('index out of bounds')
-                starta[i] = s
-                edgesa[i] = 1
-                dims[i] = False
-            else:
-                if s.step is not None:
-                    raise IndexError('stride not supported')
-                start, stop = s.start, s.stop
-                if start is None: start = 0
-                if stop is None: stop = n
-                if start < 0: start += n
-                if stop < 0: stop += n
-                start = min(max(0, n-1), max(0, start))
-                stop = min(n, max(0, stop))
-                starta[i] = start
-                edgesa[i] = max(0, stop - start)
-
-        data = self.hdf._read(self.name, starta, edgesa)
-        shape = []
-        for n, d in zip(data.shape, dims):
-            if d: shape.append(n)
-        if len(shape) == 0: return data.ravel()[0]
-        else: return data.reshape(shape)
+    @autostr
+    def iter_blocks(self, axis=0, size=1000):
+        """Iterate over successive blocks of at most size elements along
+        axis. Yields tuples (offset, data), where offset is the start of
+        the block along axis.
+        """
+        if axis < 0: axis += self.rank
+        if axis < 0 or axis >= self.rank: raise IndexError('axis out of range')
+        if size <= 0: raise ValueError('size must be positive')
+        key = [slice(None)]*self.rank
+        for i in range(0, self.shape[axis], size):
+            key[axis] = slice(i, i + size)
+            starta, edgesa, stridea, dims = _hyperslab(tuple(key), self.shape)
+            yield i, self.hdf._read(self.name, starta, edgesa, stridea)
+
+    def read_async(self, key=slice(None), executor=None):
+        """Read the part of the dataset selected by key on a reader thread.
+        Returns an awaitable of the result of ds[key]. executor is
+        an instance of concurrent.futures.Executor or None for the default
+        pool of reader threads (see ccplot.concurrency)."""
+        return run_async(self.__getitem__, key, executor=executor)
+
+    def prefetch(self, key=slice(None), executor=None):
+        """Schedule reading of the part of the dataset selected by key on
+        a reader thread. Returns an instance of concurrent.futures.Future
+        of the result of ds[key]. executor is an instance of
+        concurrent.futures.Executor or None for the default pool of reader
+        threads (see ccplot.concurrency)."""
+        return submit(self.__getitem__, key, executor=executor)
 
 
 class Vdata(DictMixin, Autostr):
@@ -179,9 +317,23 @@ class Vdata(DictMixin, Autostr):
         # Ensure that such Vdata exists.
         self.fields = self.hdf._vdata_fields(name)
 
+    def __reduce__(self):
+        return (Vdata, (self.hdf, self.name))
+
     @autostr
     def __getitem__(self, key):
-        data = self.hdf._read_vdata(self.name, key)
+        if type(key) is tuple:
+            # Subset of records: vdata[field, index].
+            name, index = key
+            if type(name) is str: name = name.encode(self._encoding)
+            n_records = self.hdf._vsattach(self.name)['n_records']
+            starta, edgesa, stridea, dims = \
+                _hyperslab(index, np.array([n_records], dtype=np.int32))
+            start, count, stride = starta[0], edgesa[0], stridea[0]
+            nread = (count - 1)*stride + 1 if count > 0 else 0
+            data = self.hdf._read_vdata(self.name, name, start, nread, stride)
+        else:
+            data = self.hdf._read_vdata(self.name, key)
         if type(data) == np.ndarray and len(data) == 1:
             return data[0]
         return data
@@ -198,39 +350,98 @@ class SDS(Autostr):
         self.name = name
 
     def __enter__(self):
-        errno = 0
-        index = SDnametoindex(self.hdf.sd, self.name)
-        if index == FAIL: raise KeyError(self._autostr(self.name))
-        self.sds = SDselect(self.hdf.sd, index)
-        if self.sds == FAIL:
-            self.hdf._error('HDF: SDselect of dataset "%s" failed' % self.name)
+        hdf_lock.acquire()
+        try: self.sds = self.hdf._select(self.name)
+        except:
+            hdf_lock.release()
+            raise
         return self.sds
 
     def __exit__(self, exc_type, exc_value, traceback):
-        SDendaccess(self.sds)
+        # Access is ended by HDF when the SDS is evicted from the cache
+        # or the file is closed.
+        hdf_lock.release()
 
 
 class HDF(DictMixin, Autostr):
-    def __init__(self, filename, encoding='utf-8', mode=None):
+    @locked
+    def __init__(self, filename, encoding='utf-8', mode=None,
+                 shared_cache=False):
         if mode not in (None, 'binary', 'text'):
             raise ValueError('mode must be one of: None, "binary", "text"')
         if mode is None:
             mode = 'text' if type(filename) is str else 'binary'
         self._mode = mode
         self._encoding = encoding
-        filename = os.fsencode(filename)
-        self.filename = filename
+        self.filename = os.fsencode(filename)
+        self._reset(shared_cache)
+        self._open()
+
+    def __getstate__(self):
+        # Only the arguments of the constructor are pickled. The file is
+        # opened again on first use after unpickling, e.g. in a worker
+        # process.
+        return {
+            'filename': self.filename,
+            'encoding': self._encoding,
+            'mode': self._mode,
+            'shared_cache': self._shared_cache is not None,
+        }
+
+    def __setstate__(self, state):
+        self._mode = state['mode']
+        self._encoding = state['encoding']
+        self.filename = state['filename']
+        self._reset(state['shared_cache'])
+        self._reopen = True
+
+    def _reset(self, shared_cache):
+        # Opt-in cache of whole datasets in shared memory (see
+        # ccplot.shmcache).
+        self._shared_cache = None
+        if shared_cache:
+            from .shmcache import get_cache, file_identity
+            self._shared_cache = get_cache()
+            self._identity = file_identity(self.filename)
+        self._sd = None
+        self._hd = None
+        self._reopen = False
+        self._sds_cache = OrderedDict()
+        self._info_cache = {}
+        self._vdata_cache = {}
+        self._catalog_cache = None
+        self._chunk_cache = OrderedDict()
+        self._chunk_cache_nbytes = 0
+        self._chunk_cache_hits = 0
+        self._chunk_cache_misses = 0
+        self.attributes = Attributes(self)
 
-        self.sd = SDstart(filename, DFACC_READ)
-        if self.sd == FAIL: self._error('HDF: SDstart failed', from_errno=True)
+    @locked
+    def _open(self):
+        if self._sd is not None: return
+        self._reopen = False
 
-        self.hd = Hopen(filename, DFACC_READ, 0)
-        if self.hd == FAIL: self._error('HDF: Hopen failed', from_errno=True)
+        sd = SDstart(self.filename, DFACC_READ)
+        if sd == FAIL: self._error('HDF: SDstart failed', from_errno=True)
 
-        res = Vstart(self.hd)
+        hd = Hopen(self.filename, DFACC_READ, 0)
+        if hd == FAIL: self._error('HDF: Hopen failed', from_errno=True)
+
+        res = Vstart(hd)
         if res == FAIL: self._error('HDF: Vstart failed', from_errno=True)
 
-        self.attributes = Attributes(self)
+        self._sd = sd
+        self._hd = hd
+
+    @property
+    def sd(self):
+        if self._reopen: self._open()
+        return self._sd
+
+    @property
+    def hd(self):
+        if self._reopen: self._open()
+        return self._hd
 
     def __enter__(self):
         return self
@@ -238,32 +449,87 @@ class HDF(DictMixin, Autostr):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    @locked
     def close(self):
-        SDend(self.sd)
-        self.sd = None
-        Vend(self.hd)
-        Hclose(self.hd)
-        self.hd = None
+        self._reopen = False
+        for sds in self._sds_cache.values():
+            SDendaccess(sds)
+        self._sds_cache.clear()
+        self._info_cache.clear()
+        if self._sd is not None: SDend(self._sd)
+        self._sd = None
+        for info in self._vdata_cache.values():
+            VSdetach(info['id'])
+        self._vdata_cache.clear()
+        self._catalog_cache = None
+        self._chunk_cache.clear()
+        self._chunk_cache_nbytes = 0
+        if self._hd is not None:
+            Vend(self._hd)
+            Hclose(self._hd)
+        self._hd = None
 
     @autostr
     def __getitem__(self, key):
-        # Try SDS.
-        try:
-            with SDS(self, key) as sds: pass
+        kind = self._catalog()[0].get(key)
+        if kind == 'sds':
             return Dataset(self, key)
-        except KeyError: pass
-
-        # Try Vdata.
-        try:
+        elif kind == 'vdata':
             return Vdata(self, key)
-        except KeyError: pass
-
         raise KeyError(self._autostr(key))
 
+    @autostr
+    def __contains__(self, key):
+        return key in self._catalog()[0]
+
     @autostr
     def keys(self):
-        return self._list_datasets() + self._list_vdata()
+        return list(self._catalog()[1])
+
+    def read_many(self, keys):
+        """Read multiple datasets. keys is a dictionary of dataset names and
+        keys as accepted by Dataset.__getitem__. Returns a dictionary of
+        dataset names and arrays. Datasets are read in the order in which
+        they are stored in the file."""
+        names = {}
+        for name in keys:
+            names[name] = name.encode(self._encoding) \
+                if type(name) is str else name
+        order = sorted(keys, key=lambda name: self._getinfo(names[name])['index'])
+        data = {}
+        for name in order:
+            info = self._getinfo(names[name])
+            starta, edgesa, stridea, dims = _hyperslab(keys[name], info['shape'])
+            data[name] = _squeeze(
+                self._read(names[name], starta, edgesa, stridea),
+                dims
+            )
+        return data
+
+    def prefetch(self, keys, executor=None):
+        """Schedule reading of multiple datasets on a reader thread. keys
+        is a dictionary as accepted by read_many, or a list of names of
+        datasets to be read whole. Returns an instance of
+        concurrent.futures.Future of the result of read_many. executor is
+        an instance of concurrent.futures.Executor or None for the default
+        pool of reader threads (see ccplot.concurrency)."""
+        if not isinstance(keys, dict):
+            keys = {name: slice(None) for name in keys}
+        return submit(self.read_many, keys, executor=executor)
+
+    def chunk_cache_info(self):
+        """Return a dictionary of statistics of the cache of decompressed
+        chunks: hits, misses, number of cached chunks (chunks), their size
+        in bytes (nbytes) and the maximum size in bytes (maxbytes)."""
+        return {
+            'hits': self._chunk_cache_hits,
+            'misses': self._chunk_cache_misses,
+            'chunks': len(self._chunk_cache),
+            'nbytes': self._chunk_cache_nbytes,
+            'maxbytes': CHUNK_CACHE_SIZE,
+        }
 
+    @locked
     def _list_datasets(self):
         cdef int32 rank, data_type, num_datasets, num_global_attrs, num_attrs
         cdef np.ndarray[int32, ndim=1] dims
@@ -279,6 +545,7 @@ class HDF(DictMixin, Autostr):
             tmp = np.zeros(FIELDNAMELENMAX, dtype=np.byte)
             sds = SDselect(self.sd, i)
             res = SDgetinfo(sds, <char *>tmp.data, &rank, <int32 *>dims.data, &data_type, &num_attrs)
+            SDendaccess(sds)
             if res == FAIL: self._error('HDF: SDgetinfo failed')
             sds_name = bytes(bytearray(tmp)).rstrip(b'\0')
             datasets.append(sds_name)
@@ -286,6 +553,31 @@ class HDF(DictMixin, Autostr):
 
     def _list_vdata(self):
         """Return a list of pure Vdata elements."""
+        return [name for name, vdata_class in self._walk_vdata()
+            if len(vdata_class) == 0 and len(name) > 0]
+
+    def _catalog(self):
+        """Return a tuple of a dictionary of all SDS and Vdata names with
+        values 'sds' or 'vdata', and a list of keys (SDS and pure Vdata).
+        The file is listed on first use only."""
+        if self._catalog_cache is not None:
+            return self._catalog_cache
+        datasets = self._list_datasets()
+        vdata = self._walk_vdata()
+        names = {}
+        for name, vdata_class in vdata:
+            names[name] = 'vdata'
+        # SDS take precedence over Vdata of the same name.
+        for name in datasets:
+            names[name] = 'sds'
+        keys = datasets + [name for name, vdata_class in vdata
+            if len(vdata_class) == 0 and len(name) > 0]
+        self._catalog_cache = (names, keys)
+        return self._catalog_cache
+
+    @locked
+    def _walk_vdata(self):
+        """Return a list of tuples (name, class) of all Vdata elements."""
         cdef char[VSNAMELENMAX] tmp
         out = []
         ref = VSgetid(self.hd, -1)
@@ -299,14 +591,32 @@ class HDF(DictMixin, Autostr):
                 res = VSgetclass(id, tmp)
                 if res == FAIL: self._error('HDF: VSgetclass failed')
                 vdata_class = tmp
-                if len(vdata_class) == 0 and len(name) > 0:
-                    out.append(name)
+                out.append((name, vdata_class))
             finally:
                 res = VSdetach(id)
                 if res == FAIL: self._error('HDF: VSdetach failed')
             ref = VSgetid(self.hd, ref)
         return out
 
+    @locked
+    def _select(self, name):
+        """Return an SDS id of dataset name. The id is cached in a bounded
+        LRU cache, and access to it is ended on eviction or close()."""
+        try:
+            sds = self._sds_cache.pop(name)
+        except KeyError:
+            index = SDnametoindex(self.sd, name)
+            if index == FAIL: raise KeyError(self._autostr(name))
+            sds = SDselect(self.sd, index)
+            if sds == FAIL:
+                self._error('HDF: SDselect of dataset "%s" failed' % name)
+            while len(self._sds_cache) >= SDS_CACHE_SIZE:
+                old_name, old_sds = self._sds_cache.popitem(last=False)
+                self._info_cache.pop(old_name, None)
+                SDendaccess(old_sds)
+        self._sds_cache[name] = sds
+        return sds
+
     def _error(self, errmsg=None, from_errno=False):
         errcode = HEvalue(1)
         if errcode != 0:
@@ -319,6 +629,7 @@ class HDF(DictMixin, Autostr):
         else:
             raise IOError(0, 'HDF: Unknown error', os.fsdecode(self.filename))
 
+    @locked
     def _attributes(self, dataset=None):
         cdef int32 num_datasets, num_global_attrs
 
@@ -328,8 +639,11 @@ class HDF(DictMixin, Autostr):
             return self._attributes2(self.sd, num_global_attrs)
         else:
             info = self._getinfo(dataset)
-            with SDS(self, dataset) as sds:
-                return self._attributes2(sds, info['num_attrs'])
+            if 'attributes' not in info:
+                with SDS(self, dataset) as sds:
+                    info['attributes'] = \
+                        self._attributes2(sds, info['num_attrs'])
+            return list(info['attributes'])
 
     def _attributes2(self, obj_id, n):
         cdef np.ndarray[char, ndim=1] tmp
@@ -344,21 +658,31 @@ class HDF(DictMixin, Autostr):
             attrs.append(attr_name)
         return attrs
 
+    @locked
     def _getinfo(self, name):
         cdef int32 rank, data_type, num_attrs
         cdef np.ndarray[int32, ndim=1] dims
+        try: return self._info_cache[name]
+        except KeyError: pass
         dims = np.zeros(H4_MAX_VAR_DIMS, dtype=np.int32)
+        index = SDnametoindex(self.sd, name)
+        if index == FAIL: raise KeyError(self._autostr(name))
         with SDS(self, name) as sds:
             res = SDgetinfo(sds, NULL, &rank, <int32 *>dims.data, &data_type, &num_attrs)
         if res == FAIL: self._error('HDF: SDgetinfo on dataset "%s" failed' % name)
         try: dtype = DTYPE[data_type]
         except KeyError: raise NotImplementedError('%s: %s: Data type %d not implemented'
                                               % (os.fsdecode(self.filename), self._autostr(name), data_type))
-        return {
-            'shape': dims[:rank],
+        shape = dims[:rank].copy()
+        shape.flags.writeable = False
+        info = {
+            'index': index,
+            'shape': shape,
             'dtype': dtype,
             'num_attrs': num_attrs,
         }
+        self._info_cache[name] = info
+        return info
 
     def _normalize(self, index, dims, default=0, incl=False):
         if len(index) > len(dims):
@@ -373,7 +697,7 @@ class HDF(DictMixin, Autostr):
                 raise IndexError('index out of bounds')
         return newindex
 
-    def _read(self, name, start, edges):
+    def _read(self, name, start, edges, stride=None, out=None, cache=True):
         info = self._getinfo(name)
         shape = info['shape']
         dtype = info['dtype']
@@ -381,19 +705,208 @@ class HDF(DictMixin, Autostr):
         if len(start) != len(shape) or len(edges) != len(shape):
             raise IndexError('invalid number of indices')
 
+        if stride is None:
+            stride = np.ones(len(shape), dtype=np.int32)
+        elif len(stride) != len(shape):
+            raise IndexError('invalid number of indices')
+
         if np.any(np.logical_or(start < 0, start >= shape)) or\
            np.any(np.logical_or(edges < 0, edges - start > shape)):
             raise IndexError('index out of bounds')
 
+        if np.any(stride < 1) or \
+           np.any((edges > 0) & (start + (edges - 1)*stride >= shape)):
+            raise IndexError('index out of bounds')
+
         cdef np.ndarray[int32, ndim=1] cstart = np.array(start, dtype=np.int32)
         cdef np.ndarray[int32, ndim=1] cedges = np.array(edges, dtype=np.int32)
-        data = np.zeros(edges, dtype=dtype)
-        cdef np.ndarray[char, ndim=1] buf = data.view(dtype=np.int8).ravel()
+        cdef np.ndarray[int32, ndim=1] cstride = np.array(stride, dtype=np.int32)
+        # NULL stride lets the library take its contiguous read path.
+        cdef int32 *pstride = NULL
+        if np.any(cstride != 1): pstride = <int32 *>cstride.data
+        if out is not None:
+            if not isinstance(out, np.ndarray) or out.dtype != dtype:
+                raise ValueError('out must be an array of dtype %s' % np.dtype(dtype))
+            if not out.flags.c_contiguous or not out.flags.writeable:
+                raise ValueError('out must be a writeable C-contiguous array')
+            if out.size != np.prod(edges):
+                raise ValueError('out has size %d, expected %d' % (out.size, np.prod(edges)))
+        if cache and self._shared_cache is not None:
+            whole = self._shared(name)
+            if whole is not None:
+                index = _slices(cstart, cedges, cstride)
+                if out is None:
+                    # Read-only view of the shared memory segment.
+                    return whole[index]
+                np.copyto(out.reshape(edges), whole[index])
+                return out
+        data = np.zeros(edges, dtype=dtype) if out is None else out
+        mm = self._memmap(name)
+        if mm is not None:
+            # Copy (and byte-swap) only the selected part of the file.
+            np.copyto(data.reshape(edges), mm[_slices(cstart, cedges, cstride)])
+            return data
+        chunks = self._chunks(name)
+        if chunks is not None and \
+           self._read_chunked(name, chunks, cstart, cedges, cstride, data.reshape(edges)):
+            return data
+        cdef np.ndarray[char, ndim=1] buf = data.reshape(-1).view(dtype=np.int8)
+        cdef int32 *pstart = <int32 *>cstart.data
+        cdef int32 *pedges = <int32 *>cedges.data
+        cdef void *pbuf = <void *>buf.data
+        cdef int32 csds
+        cdef intn res
         with SDS(self, name) as sds:
-            res = SDreaddata(sds, <int32 *>cstart.data, NULL, <int32 *>cedges.data, <void *>buf.data);
+            csds = sds
+            # Other threads can run while the library is reading.
+            with nogil:
+                res = SDreaddata(csds, pstart, pstride, pedges, pbuf)
+        if out is not None:
+            return out
         data = buf.view(dtype=dtype).reshape(edges)
         return data
 
+    def _shared(self, name):
+        """Return a read-only array of the whole dataset name from the shared
+        cache, or None if it cannot be shared. The dataset is read and
+        published in the cache if no process has done so yet."""
+        info = self._getinfo(name)
+        shape = info['shape']
+        def fill(out):
+            self._read(name, np.zeros(len(shape), dtype=np.int32), shape,
+                out=out, cache=False)
+        return self._shared_cache.get((self._identity, name), info['dtype'],
+            shape, fill)
+
+    @locked
+    def _chunks(self, name):
+        """Return a tuple of chunk lengths of dataset name, or None if the
+        dataset is not chunked. The result is cached in dataset info."""
+        cdef HDF_CHUNK_DEF chunk_def
+        cdef int32 flags
+        info = self._getinfo(name)
+        try: return info['chunks']
+        except KeyError: pass
+        rank = len(info['shape'])
+        with SDS(self, name) as sds:
+            res = SDgetchunkinfo(sds, &chunk_def, &flags)
+        if res == FAIL or not (flags & HDF_CHUNK):
+            chunks = None
+        else:
+            chunks = tuple(chunk_def.chunk_lengths[i] for i in range(rank))
+        info['chunks'] = chunks
+        return chunks
+
+    def _read_chunked(self, name, chunks, start, edges, stride, data):
+        """Read a hyperslab of a chunked dataset into data (an array of shape
+        edges) chunk by chunk through the chunk cache. Returns False without
+        reading if the chunks would not fit in the cache or a chunk cannot
+        be read, in which case the hyperslab should be read with
+        SDreaddata."""
+        dtype = np.dtype(self._getinfo(name)['dtype'])
+        # For each dimension, a list of chunk indices and slices of data
+        # and of the chunk which overlap.
+        parts = []
+        for s, e, st, n in zip(start, edges, stride, chunks):
+            if e == 0: return True
+            dim_parts = []
+            for c in range(s//n, (s + (e - 1)*st)//n + 1):
+                lo = c*n
+                i0 = max(0, -((s - lo)//st))
+                i1 = min(e, -((s - lo - n)//st))
+                if i1 <= i0: continue
+                dim_parts.append((
+                    c,
+                    slice(i0, i1),
+                    slice(s + i0*st - lo, s + (i1 - 1)*st - lo + 1, st)
+                ))
+            parts.append(dim_parts)
+        nchunks = np.prod([len(p) for p in parts])
+        if nchunks*np.prod(chunks)*dtype.itemsize > CHUNK_CACHE_SIZE:
+            return False
+        for part in itertools.product(*parts):
+            coords = tuple(int(p[0]) for p in part)
+            chunk = self._readchunk(name, coords, chunks, dtype)
+            if chunk is None: return False
+            data[tuple(p[1] for p in part)] = chunk[tuple(p[2] for p in part)]
+        return True
+
+    @locked
+    def _readchunk(self, name, coords, chunks, dtype):
+        """Return a read-only array of the decompressed chunk of dataset
+        name at chunk coordinates coords, or None if it cannot be read.
+        Chunks are kept in a size-bounded LRU cache."""
+        cdef np.ndarray[int32, ndim=1] ccoords
+        cdef np.ndarray chunk
+        cdef int32 *pcoords
+        cdef void *pbuf
+        cdef int32 csds
+        cdef intn res
+        key = (name, coords)
+        try:
+            chunk = self._chunk_cache.pop(key)
+            self._chunk_cache[key] = chunk
+            self._chunk_cache_hits += 1
+            return chunk
+        except KeyError: pass
+        self._chunk_cache_misses += 1
+        ccoords = np.array(coords, dtype=np.int32)
+        chunk = np.empty(chunks, dtype=dtype)
+        pcoords = <int32 *>ccoords.data
+        pbuf = <void *>chunk.data
+        with SDS(self, name) as sds:
+            csds = sds
+            with nogil:
+                res = SDreadchunk(csds, pcoords, pbuf)
+        if res == FAIL: return None
+        chunk.flags.writeable = False
+        self._chunk_cache[key] = chunk
+        self._chunk_cache_nbytes += chunk.nbytes
+        while self._chunk_cache_nbytes > CHUNK_CACHE_SIZE:
+            old_key, old_chunk = self._chunk_cache.popitem(last=False)
+            self._chunk_cache_nbytes -= old_chunk.nbytes
+        return chunk
+
+    @locked
+    def _memmap(self, name):
+        """Return a read-only memory map of dataset name if it is stored
+        uncompressed in a single contiguous block of the file, or None if
+        it has to be read with SDreaddata. The map is cached in dataset
+        info."""
+        cdef comp_coder_t comp_type
+        cdef int32 flags, offset, length
+        info = self._getinfo(name)
+        try: return info['memmap']
+        except KeyError: pass
+        info['memmap'] = None
+        dtype = np.dtype(info['dtype']).newbyteorder('>')
+        nbytes = int(np.prod(info['shape']))*dtype.itemsize
+        if nbytes == 0:
+            return None
+        with SDS(self, name) as sds:
+            if SDgetcomptype(sds, &comp_type) == FAIL or \
+               comp_type != COMP_CODE_NONE:
+                return None
+            if SDgetchunkinfo(sds, NULL, &flags) == FAIL or \
+               flags != HDF_NONE:
+                return None
+            # Data stored in an external file.
+            if SDgetexternalinfo(sds, 0, NULL, NULL, NULL) != 0:
+                return None
+            if SDgetdatainfo(sds, NULL, 0, 0, NULL, NULL) != 1:
+                return None
+            res = SDgetdatainfo(sds, NULL, 0, 1, &offset, &length)
+            if res != 1 or length != nbytes:
+                return None
+        try:
+            mm = np.memmap(os.fsdecode(self.filename), dtype=dtype,
+                mode='r', offset=offset, shape=tuple(info['shape']))
+        except (IOError, ValueError):
+            return None
+        info['memmap'] = mm
+        return mm
+
+    @locked
     def _readattr(self, dataset, name):
         if dataset is not None:
             with SDS(self, dataset) as sds:
@@ -402,9 +915,12 @@ class HDF(DictMixin, Autostr):
             return self._readattr2(self.sd, name)
 
     def _readattr2(self, obj_id, name):
-        cdef int32 data_type, count
         index = SDfindattr(obj_id, name)
         if index == FAIL: raise KeyError(self._autostr(name))
+        return self._readattr3(obj_id, index, name)
+
+    def _readattr3(self, obj_id, index, name):
+        cdef int32 data_type, count
         cdef np.ndarray[char, ndim=1] tmp
         tmp = np.zeros(FIELDNAMELENMAX, dtype=np.byte)
         res = SDattrinfo(obj_id, index, <char *>tmp.data, &data_type, &count)
@@ -427,67 +943,116 @@ class HDF(DictMixin, Autostr):
 
         return data[0] if count == 1 else data
 
-    def _read_vdata(self, vdata, name):
-        cdef int32 n_records
-        cdef np.ndarray[uint8, ndim=1] buf, data
-        cdef int32 index
-
-        ref = VSfind(self.hd, vdata)
-        if ref == 0: raise KeyError(self._autostr(vdata))
-        id = VSattach(self.hd, ref, 'r')
-        if id == FAIL: self._error('HDF: VSattach of "%s" failed' % vdata)
-        try:
-            res = VSinquire(id, &n_records, NULL, NULL, NULL, NULL)
-            if res == FAIL: self._error('HDF: VSinquire failed')
-
-            res = VSsetfields(id, name)
-            if res == FAIL: raise KeyError(self._autostr(name))
-
-            size = VSsizeof(id, name)
-            if size == FAIL: self._error('HDF: VSsizeof failed')
-
-            buf = np.zeros(size*n_records, dtype=np.uint8)
-            res = VSread(id, <uint8 *>buf.data, n_records, FULL_INTERLACE)
-            data = buf
-
-            # Find out field type.
-            res = VSfindex(id, name, &index)
-            if res == FAIL: self._error('HDF: VSfindex failed')
-            data_type = VFfieldtype(id, index)
-            if data_type == FAIL: self._error('HDF: VFfieldtype failed')
-            try:
-                dtype = DTYPE[data_type]
-            except KeyError:
-                raise NotImplementedError(
-                    '%s: %s: %s: Data type %d not implemented' %
-                    (os.fsdecode(self.filename), self._autostr(vdata), self._autostr(name), data_type)
-                )
-
-            if data_type == DFNT_CHAR:
-                return bytes(bytearray(data)).rstrip(b'\0')
-            else:
-                return data.view(dtype=dtype)
-
-        finally:
-            res = VSdetach(id)
-            if res == FAIL: self._error('HDF: VSdetach failed')
+    @locked
+    def _readattrs(self, dataset=None):
+        """Read all attributes of dataset, or global attributes if dataset
+        is None. Returns a dictionary of attribute names and values.
+        The value of an attribute of an unsupported data type is
+        the NotImplementedError raised on reading it."""
+        names = self._attributes(dataset)
+        if dataset is None:
+            return self._readattrs2(self.sd, names)
+        with SDS(self, dataset) as sds:
+            return self._readattrs2(sds, names)
+
+    def _readattrs2(self, obj_id, names):
+        attrs = {}
+        for index, name in enumerate(names):
+            try: attrs[name] = self._readattr3(obj_id, index, name)
+            except NotImplementedError as e: attrs[name] = e
+        return attrs
 
-    def _vdata_fields(self, name):
+    @locked
+    def _vsattach(self, name):
+        """Return a dictionary of id, ref, number of records and field names
+        of Vdata name. The Vdata is attached on first access and stays
+        attached until close()."""
+        cdef int32 n_records
         cdef char *tmp
-        fields = []
+        try: return self._vdata_cache[name]
+        except KeyError: pass
         ref = VSfind(self.hd, name)
         if ref == 0: raise KeyError(self._autostr(name))
         id = VSattach(self.hd, ref, 'r')
         if id == FAIL: self._error('HDF: VSattach of "%s" failed' % self._autostr(name))
         try:
+            res = VSinquire(id, &n_records, NULL, NULL, NULL, NULL)
+            if res == FAIL: self._error('HDF: VSinquire failed')
+            fields = []
             nfields = VFnfields(id)
             if nfields == FAIL: self._error('HDF: VFnfields failed')
             for index in range(nfields):
                 tmp = VFfieldname(id, index)
                 if tmp == NULL: self._error('HDF: VFfieldname failed')
-                name = tmp
-                fields.append(name)
-        finally:
-            res = VSdetach(id)
-            if res == FAIL: self._error('HDF: VSdetach failed')
-        return fields
+                field = tmp
+                fields.append(field)
+        except:
+            VSdetach(id)
+            raise
+        info = {
+            'id': id,
+            'ref': ref,
+            'n_records': n_records,
+            'fields': fields,
+        }
+        self._vdata_cache[name] = info
+        return info
+
+    @locked
+    def _read_vdata(self, vdata, name, start=0, count=None, stride=1,
+                    raw=False):
+        """Read count records from start of field name of Vdata vdata,
+        keeping every stride-th record. Character fields are returned as
+        bytes with trailing null characters removed, or as an array of
+        the characters of all records if raw is True."""
+        cdef np.ndarray[uint8, ndim=1] buf, data
+        cdef int32 index, cid, ccount, nread
+        cdef uint8 *pbuf
+
+        info = self._vsattach(vdata)
+        id = info['id']
+        n_records = info['n_records']
+        if count is None: count = n_records - start
+        if start < 0 or count < 0 or start + count > n_records:
+            raise IndexError('index out of bounds')
+
+        res = VSsetfields(id, name)
+        if res == FAIL: raise KeyError(self._autostr(name))
+
+        size = VSsizeof(id, name)
+        if size == FAIL: self._error('HDF: VSsizeof failed')
+
+        buf = np.zeros(size*count, dtype=np.uint8)
+        if count > 0:
+            res = VSseek(id, start)
+            if res == FAIL: self._error('HDF: VSseek failed')
+            cid = id
+            pbuf = <uint8 *>buf.data
+            ccount = count
+            with nogil:
+                nread = VSread(cid, pbuf, ccount, FULL_INTERLACE)
+            if nread == FAIL: self._error('HDF: VSread failed')
+        # Strided before conversion, so that records of character fields
+        # are selected in the same way as of other fields.
+        data = buf.reshape(count, size)[::stride].ravel() if stride > 1 else buf
+
+        # Find out field type.
+        res = VSfindex(id, name, &index)
+        if res == FAIL: self._error('HDF: VSfindex failed')
+        data_type = VFfieldtype(id, index)
+        if data_type == FAIL: self._error('HDF: VFfieldtype failed')
+        try:
+            dtype = DTYPE[data_type]
+        except KeyError:
+            raise NotImplementedError(
+                '%s: %s: %s: Data type %d not implemented' %
+                (os.fsdecode(self.filename), self._autostr(vdata), self._autostr(name), data_type)
+            )
+
+        if data_type == DFNT_CHAR and not raw:
+            return bytes(bytearray(data)).rstrip(b'\0')
+        else:
+            return data.view(dtype=dtype)
+
+    def _vdata_fields(self, name):
+        return list(self._vsattach(name)['fields'])
@@ -3,8 +3,11 @@ cimport numpy as np
 import sys
 import os
 import numpy as np
+from collections import OrderedDict
 from ccplot import hdf
+from ccplot.hdf import _hyperslab, _squeeze
 from .autostr import autostr, Autostr
+from .concurrency import hdf_lock, locked, run_async, submit
 
 if sys.version_info[0] == 2:
     from UserDict import DictMixin as DictMixin
@@ -73,7 +76,7 @@ cdef extern from "HdfEosDef.h":
     intn SWfieldinfo(int32, char *, int32 *, int32 [], int32 *, char *)
     intn SWreadattr(int32, char *, VOIDP)
     intn SWattrinfo(int32, char *, int32 *, int32 *)
-    intn SWreadfield(int32, char *, int32 [], int32 [], int32 [], VOIDP)
+    intn SWreadfield(int32, char *, int32 [], int32 [], int32 [], VOIDP) nogil
     intn SWgetfillvalue(int32, char *, VOIDP)
     intn SWdetach(int32)
     intn SWclose(int32)
@@ -106,31 +109,49 @@ class Attributes(DictMixin, Autostr):
         self.hdfeos = hdfeos
         self.swath = swath
         self.dataset = dataset
+        self._snapshot = None
+
+    def __reduce__(self):
+        return (Attributes, (self.hdfeos, self.swath, self.dataset))
+
+    def _load(self):
+        if self._snapshot is not None:
+            return self._snapshot
+        if self.swath is None:
+            snapshot = self.hdfeos.hdf.attributes._load()
+        else:
+            snapshot = self.hdfeos._readattrs(self.swath, self.dataset)
+            # Fall back to attributes of the underlying SDS.
+            if self.dataset is not None:
+                try: attrs = self.hdfeos.hdf[self.dataset].attributes._load()
+                except (KeyError, AttributeError): attrs = {}
+                for k, v in attrs.items():
+                    snapshot.setdefault(k, v)
+        self._snapshot = snapshot
+        return snapshot
+
+    @autostr
+    def load_all(self):
+        """Read all attributes in one pass and return them as a dictionary.
+        Attributes are then looked up in this snapshot without further
+        library calls. Attributes of unsupported data types are omitted."""
+        return {k: v for k, v in self._load().items()
+            if not isinstance(v, NotImplementedError)}
 
     @autostr
     def __getitem__(self, key):
-        if self.swath is None:
-            return self.hdfeos.hdf.attributes[key]
+        try: value = self._load()[key]
+        except KeyError: raise KeyError(self._autostr(key))
+        if isinstance(value, NotImplementedError): raise value
+        return value
 
-        try:
-            return self.hdfeos._readattr(self.swath, self.dataset, key)
-        except KeyError:
-            if self.dataset is not None:
-                try:
-                    return self.hdfeos.hdf[self.dataset].attributes[key]
-                except KeyError: raise KeyError(self._autostr(key))
-            else: raise KeyError(self._autostr(key))
+    @autostr
+    def __contains__(self, key):
+        return key in self._load()
 
     @autostr
     def keys(self):
-        if self.swath is None:
-            return self.hdfeos.hdf.attributes.keys()
-
-        attrs = self.hdfeos._attributes(self.swath, self.dataset)
-        if self.dataset is not None:
-            try: attrs += self.hdfeos.hdf[self.dataset].attributes.keys()
-            except KeyError: pass
-        return attrs
+        return list(self._load().keys())
 
 
 class Dataset(Autostr):
@@ -142,47 +163,89 @@ class Dataset(Autostr):
         info = self.hdfeos._getinfo(swath, name)
         self.shape = info['shape']
         self.rank = len(self.shape)
+        self.ndim = self.rank
+        self.dtype = np.dtype(info['dtype'])
         self.dims = info['dimlist']
         self.attributes = Attributes(self.hdfeos, swath, name)
 
+    def __reduce__(self):
+        # Pickled as a reference to the field in the file.
+        return (Dataset, (self.hdfeos, self.swath, self.name))
+
+    @property
+    def chunks(self):
+        """Tuple of chunk lengths of the field in the file, or None if
+        the field is not chunked or its chunking cannot be determined."""
+        # Fields are stored as SDS of the same name. The SDS is only trusted
+        # if its shape matches, as field names can repeat across swaths.
+        try:
+            info = self.hdfeos.hdf._getinfo(self.name)
+        except KeyError:
+            return None
+        if not np.array_equal(info['shape'], self.shape):
+            return None
+        return self.hdfeos.hdf._chunks(self.name)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        if dtype is not None: data = data.astype(dtype, copy=False)
+        return data
+
     @autostr
     def __getitem__(self, key):
-        starta = np.zeros(self.rank, dtype=np.int32)
-        edgesa = self.shape.copy()
-
-        if type(key) != tuple:
-            key = (key,)
+        starta, edgesa, stridea, dims = _hyperslab(key, self.shape)
+        data = self.hdfeos._read(self.swath, self.name, starta, edgesa, stridea)
+        return _squeeze(data, dims)
 
-        if len(key) > self.rank:
-            raise IndexError('too many indices')
+    @autostr
+    def read_into(self, out, key=slice(None)):
+        """Read the part of the dataset selected by key into out and return
+        out. out must be a writeable C-contiguous array of dtype of
+        the dataset and of the shape which ds[key] would return."""
+        if not isinstance(out, np.ndarray) or out.dtype != self.dtype:
+            raise ValueError('out must be an array of dtype %s' % self.dtype)
+        starta, edgesa, stridea, dims = _hyperslab(key, self.shape)
+        shape = tuple(edgesa[dims])
+        if out.shape != shape:
+            raise ValueError('out has shape %s, expected %s' % (out.shape, shape))
+        if not out.flags.c_contiguous or not out.flags.writeable:
+            raise ValueError('out must be a writeable C-contiguous array')
+        self.hdfeos._read(self.swath, self.name, starta, edgesa, stridea, out=out)
+        return out
 
-        dims = np.ones(self.rank, dtype=bool)
-        for i, s, n in zip(range(self.rank), key, self.shape):
-            if type(s) != slice:
-                if s < 0: s += n
-                if s < 0 or s >= n: raise IndexError('index out of bounds')
-                starta[i] = s
-                edgesa[i] = 1
-                dims[i] = False
-            else:
-                if s.step is not None:
-                    raise IndexError('stride not supported')
-                start, stop = s.start, s.stop
-                if start is None: start = 0
-                if stop is None: stop = n
-                if start < 0: start += n
-                if stop < 0: stop += n
-                start = min(max(0, n-1), max(0, start))
-                stop = min(n, max(0, stop))
-                starta[i] = start
-                edgesa[i] = max(0, stop - start)
-
-        data = self.hdfeos._read(self.swath, self.name, starta, edgesa)
-        shape = []
-        for n, d in zip(data.shape, dims):
-            if d: shape.append(n)
-        if len(shape) == 0: return data.ravel()[0]
-        else: return data.reshape(shape)
+    @autostr
+    def iter_blocks(self, axis=0, size=1000):
+        """Iterate over successive blocks of at most size elements along
+        axis. Yields tuples (offset, data), where offset is the start of
+        the block along axis.
+        """
+        if axis < 0: axis += self.rank
+        if axis < 0 or axis >= self.rank: raise IndexError('axis out of range')
+        if size <= 0: raise ValueError('size must be positive')
+        key = [slice(None)]*self.rank
+        for i in range(0, self.shape[axis], size):
+            key[axis] = slice(i, i + size)
+            starta, edgesa, stridea, dims = _hyperslab(tuple(key), self.shape)
+            # The swath is attached per block so that the HDF lock is not
+            # held while the consumer processes the block.
+            with SW(self.hdfeos, self.swath) as sw:
+                data = self.hdfeos._read2(sw, self.name, starta, edgesa, stridea)
+            yield i, data
+
+    def read_async(self, key=slice(None), executor=None):
+        """Read the part of the dataset selected by key on a reader thread.
+        Returns an awaitable of the result of ds[key]. executor is
+        an instance of concurrent.futures.Executor or None for the default
+        pool of reader threads (see ccplot.concurrency)."""
+        return run_async(self.__getitem__, key, executor=executor)
+
+    def prefetch(self, key=slice(None), executor=None):
+        """Schedule reading of the part of the dataset selected by key on
+        a reader thread. Returns an instance of concurrent.futures.Future
+        of the result of ds[key]. executor is an instance of
+        concurrent.futures.Executor or None for the default pool of reader
+        threads (see ccplot.concurrency)."""
+        return submit(self.__getitem__, key, executor=executor)
 
 
 class Swath(DictMixin, Autostr):
@@ -193,14 +256,39 @@ class Swath(DictMixin, Autostr):
         self.attributes = Attributes(self.hdfeos, self.name)
         self.maps = self.hdfeos._maps(self.name)
 
+    def __reduce__(self):
+        return (Swath, (self.hdfeos, self.name))
+
     @autostr
     def __getitem__(self, key):
+        if key not in self.hdfeos._fieldcatalog(self.name):
+            raise KeyError(self._autostr(key))
         return Dataset(self.hdfeos, self.name, key)
 
+    @autostr
+    def __contains__(self, key):
+        return key in self.hdfeos._fieldcatalog(self.name)
+
     @autostr
     def keys(self):
-        return self.hdfeos._list_geofields(self.name) + \
-            self.hdfeos._list_datafields(self.name)
+        return list(self.hdfeos._fieldcatalog(self.name))
+
+    def read_many(self, keys):
+        """Read multiple fields of the swath. keys is a dictionary of field
+        names and keys as accepted by Dataset.__getitem__. Returns
+        a dictionary of field names and arrays."""
+        return self.hdfeos._read_many(self.name, keys)
+
+    def prefetch(self, keys, executor=None):
+        """Schedule reading of multiple fields of the swath on a reader
+        thread. keys is a dictionary as accepted by read_many, or a list of
+        names of fields to be read whole. Returns an instance of
+        concurrent.futures.Future of the result of read_many. executor is
+        an instance of concurrent.futures.Executor or None for the default
+        pool of reader threads (see ccplot.concurrency)."""
+        if not isinstance(keys, dict):
+            keys = {name: slice(None) for name in keys}
+        return submit(self.read_many, keys, executor=executor)
 
 class SW(Autostr):
     @autostr
@@ -209,20 +297,24 @@ class SW(Autostr):
         self.name = name
 
     def __enter__(self):
+        hdf_lock.acquire()
         self.sw = SWattach(self.hdfeos.id, self.name)
         if self.sw == FAIL:
+            hdf_lock.release()
             raise KeyError(self._autostr(self.name))
         return self.sw
 
     def __exit__(self, exc_type, exc_value, traceback):
         res = SWdetach(self.sw)
+        hdf_lock.release()
         if res == -1:
             raise IOError(EIO, 'Failed to detach swath %d' %\
                           self.sw, os.fsdecode(self.hdfeos.filename))
 
 
 class HDFEOS(DictMixin, Autostr):
-    def __init__(self, filename, encoding='utf-8', mode=None):
+    @locked
+    def __init__(self, filename, encoding='utf-8', mode=None, hdffile=None):
         if mode not in (None, 'binary', 'text'):
             raise ValueError('mode must be one of: None, "binary", "text"')
         if mode is None:
@@ -230,29 +322,94 @@ class HDFEOS(DictMixin, Autostr):
         self._mode = mode
         self._encoding = encoding
         filename = os.fsencode(filename)
-        self.hdf = hdf.HDF(filename)
+        # Reuse an already open HDF file if supplied, e.g. by ccplot.open.
+        self.hdf = hdf.HDF(filename) if hdffile is None else hdffile
         self.filename = filename
-        self.id = SWopen(filename, DFACC_RDONLY);
-        if self.id == -1:
-            raise IOError(EIO, 'Cannot open file', os.fsdecode(self.filename))
+        self._reset()
+        self._open()
+
+    def __getstate__(self):
+        # Only the arguments of the constructor are pickled. The file is
+        # opened again on first use after unpickling.
+        return {
+            'filename': self.filename,
+            'encoding': self._encoding,
+            'mode': self._mode,
+            'hdf': self.hdf,
+        }
+
+    def __setstate__(self, state):
+        self._mode = state['mode']
+        self._encoding = state['encoding']
+        self.filename = state['filename']
+        self.hdf = state['hdf']
+        self._reset()
+        self._reopen = True
+
+    def _reset(self):
+        self._id = None
+        self._reopen = False
+        self._catalog_cache = None
+        self._fieldcatalog_cache = {}
         self.attributes = Attributes(self)
 
+    @locked
+    def _open(self):
+        if self._id is not None: return
+        self._reopen = False
+        id = SWopen(self.filename, DFACC_RDONLY);
+        if id == -1:
+            raise IOError(EIO, 'Cannot open file', os.fsdecode(self.filename))
+        self._id = id
+
+    @property
+    def id(self):
+        if self._reopen: self._open()
+        return self._id
+
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.hdf.close()
         self.close()
 
+    @locked
     def close(self):
-        SWclose(self.id)
-        self.id = None
+        self._reopen = False
+        self.hdf.close()
+        if self._id is not None: SWclose(self._id)
+        self._id = None
+        self._catalog_cache = None
+        self._fieldcatalog_cache.clear()
 
     @autostr
     def __getitem__(self, key):
-        with SW(self, key) as sw: pass
+        if key not in self._catalog():
+            raise KeyError(self._autostr(key))
         return Swath(self, key)
 
+    @autostr
+    def __contains__(self, key):
+        return key in self._catalog()
+
+    def _catalog(self):
+        """Return an ordered dictionary of swath names. The file is listed
+        on first use only."""
+        if self._catalog_cache is None:
+            self._catalog_cache = OrderedDict.fromkeys(self._list_swaths())
+        return self._catalog_cache
+
+    def _fieldcatalog(self, swath):
+        """Return an ordered dictionary of geolocation and data field names
+        of swath. The swath is listed on first use only."""
+        try: return self._fieldcatalog_cache[swath]
+        except KeyError: pass
+        fields = OrderedDict.fromkeys(
+            self._list_geofields(swath) + self._list_datafields(swath))
+        self._fieldcatalog_cache[swath] = fields
+        return fields
+
+    @locked
     def _list_swaths(self):
         cdef int32 strbufsize
         res = SWinqswath(self.filename, NULL, &strbufsize)
@@ -354,6 +511,10 @@ class HDFEOS(DictMixin, Autostr):
             return attrs
 
     def _getinfo(self, swath, name):
+        with SW(self, swath) as sw:
+            return self._getinfo2(sw, name)
+
+    def _getinfo2(self, sw, name):
         cdef int32 rank, data_type
         cdef np.ndarray[int32, ndim=1] dims
         cdef np.ndarray[char, ndim=1] tmp
@@ -361,8 +522,7 @@ class HDFEOS(DictMixin, Autostr):
         dims = np.zeros(H4_MAX_VAR_DIMS, dtype=np.int32)
         tmp = np.zeros(FIELDNAMELENMAX*(H4_MAX_VAR_DIMS+2)*2, dtype=np.byte)
 
-        with SW(self, swath) as sw:
-            res = SWfieldinfo(sw, name, &rank, <int32 *>dims.data, &data_type, <char *>tmp.data)
+        res = SWfieldinfo(sw, name, &rank, <int32 *>dims.data, &data_type, <char *>tmp.data)
         if res == FAIL: raise KeyError(self._autostr(name))
         try: dtype = DTYPE[data_type]
         except KeyError: raise NotImplementedError('%s: %s: Data type %d not implemented'
@@ -390,33 +550,98 @@ class HDFEOS(DictMixin, Autostr):
                 raise IndexError('index out of bounds')
         return newindex
 
-    def _read(self, swath, name, start, edges):
-        info = self._getinfo(swath, name)
+    def _read(self, swath, name, start, edges, stride=None, out=None):
+        with SW(self, swath) as sw:
+            return self._read2(sw, name, start, edges, stride, out)
+
+    def _read_many(self, swath, keys):
+        data = {}
+        with SW(self, swath) as sw:
+            for name, key in keys.items():
+                bname = name.encode(self._encoding) \
+                    if type(name) is str else name
+                info = self._getinfo2(sw, bname)
+                starta, edgesa, stridea, dims = _hyperslab(key, info['shape'])
+                data[name] = _squeeze(
+                    self._read2(sw, bname, starta, edgesa, stridea),
+                    dims
+                )
+        return data
+
+    def _read2(self, sw, name, start, edges, stride=None, out=None):
+        info = self._getinfo2(sw, name)
         shape = info['shape']
         dtype = info['dtype']
 
         if len(start) != len(shape) or len(edges) != len(shape):
             raise IndexError('invalid number of indices')
 
+        if stride is None:
+            stride = np.ones(len(shape), dtype=np.int32)
+        elif len(stride) != len(shape):
+            raise IndexError('invalid number of indices')
+
         if np.any(np.logical_or(start < 0, start >= shape)) or\
            np.any(np.logical_or(edges < 0, edges - start > shape)):
             raise IndexError('index out of bounds')
 
+        if np.any(stride < 1) or \
+           np.any((edges > 0) & (start + (edges - 1)*stride >= shape)):
+            raise IndexError('index out of bounds')
+
         cdef np.ndarray[int32, ndim=1] cstart = np.array(start, dtype=np.int32)
         cdef np.ndarray[int32, ndim=1] cedges = np.array(edges, dtype=np.int32)
-        data = np.zeros(edges, dtype=dtype)
-        cdef np.ndarray[char, ndim=1] buf = data.view(dtype=np.int8).ravel()
-        with SW(self, swath) as sw:
-            res = SWreadfield(sw, name, <int32 *>cstart.data, NULL, <int32 *>cedges.data, <void *>buf.data)
+        cdef np.ndarray[int32, ndim=1] cstride = np.array(stride, dtype=np.int32)
+        # NULL stride lets the library take its contiguous read path.
+        cdef int32 *pstride = NULL
+        if np.any(cstride != 1): pstride = <int32 *>cstride.data
+        if out is None:
+            data = np.zeros(edges, dtype=dtype)
+        else:
+            if not isinstance(out, np.ndarray) or out.dtype != dtype:
+                raise ValueError('out must be an array of dtype %s' % np.dtype(dtype))
+            if not out.flags.c_contiguous or not out.flags.writeable:
+                raise ValueError('out must be a writeable C-contiguous array')
+            if out.size != np.prod(edges):
+                raise ValueError('out has size %d, expected %d' % (out.size, np.prod(edges)))
+            data = out
+        cdef np.ndarray[char, ndim=1] buf = data.reshape(-1).view(dtype=np.int8)
+        cdef int32 *pstart = <int32 *>cstart.data
+        cdef int32 *pedges = <int32 *>cedges.data
+        cdef void *pbuf = <void *>buf.data
+        cdef int32 csw = sw
+        cdef char *cname = name
+        cdef intn res
+        # Other threads can run while the library is reading.
+        with nogil:
+            res = SWreadfield(csw, cname, pstart, pstride, pedges, pbuf)
+        if out is not None:
+            return out
         data = buf.view(dtype=dtype).reshape(edges)
         return data
 
     def _readattr(self, swath, dataset, name):
+        with SW(self, swath) as sw:
+            return self._readattr2(sw, dataset, name)
+
+    def _readattrs(self, swath, dataset=None):
+        """Read all attributes of swath or dataset. Returns a dictionary of
+        attribute names and values. The value of an attribute of
+        an unsupported data type is the NotImplementedError raised on
+        reading it."""
+        names = self._attributes(swath, dataset)
+        attrs = {}
+        with SW(self, swath) as sw:
+            for name in names:
+                try: attrs[name] = self._readattr2(sw, dataset, name)
+                except NotImplementedError as e: attrs[name] = e
+        return attrs
+
+    def _readattr2(self, sw, dataset, name):
         cdef int32 data_type, count
         attrname = name if dataset is None else b'%s.%s' % (dataset, name)
 
-        with SW(self, swath) as sw:
-            res = SWattrinfo(sw, attrname, &data_type, &count)
+        res = SWattrinfo(sw, attrname, &data_type, &count)
         if res == FAIL: raise KeyError(self._autostr(name))
 
         try: dtype = DTYPE[data_type]
@@ -426,8 +651,7 @@ class HDFEOS(DictMixin, Autostr):
 
         data = np.zeros(count, dtype=dtype)
         cdef np.ndarray[char, ndim=1] buf = data.view(dtype=np.int8).ravel()
-        with SW(self, swath) as sw:
-            res = SWreadattr(sw, attrname, <void *>buf.data)
+        res = SWreadattr(sw, attrname, <void *>buf.data)
         if res == FAIL:
             raise IOError(EIO, 'Cannot read attribute "%s"' % self._autostr(attrname),
                           os.fsdecode(self.filename))
@@ -439,4 +663,4 @@ class HDFEOS(DictMixin, Autostr):
 
     @autostr
     def keys(self):
-        return self._list_swaths()
+        return list(self._catalog())
@@ -0,0 +1,115 @@
+"""Packed representation of CALIPSO layer products.
+
+Layer datasets of CALIPSO layer products (such as Layer_Top_Altitude) have
+a fixed number of layers per ray, of which only the first
+Number_Layers_Found are valid. Layers stores only the valid layers, in flat
+arrays ordered by ray, with offsets of the layers of each ray
+(a compressed sparse row layout). Layers of ray i are at offsets[i] to
+offsets[i+1] in every array. Layers can be mapped onto a regular grid
+with ccplot.cctk.layermap.
+"""
+
+import numpy as np
+
+NUMBER_LAYERS = b'Number_Layers_Found'
+LAYER_BASE = b'Layer_Base_Altitude'
+LAYER_TOP = b'Layer_Top_Altitude'
+FILL_VALUE = -9999
+
+# Number of rays read at a time.
+BLOCK_SIZE = 10000
+
+
+class Layers(object):
+    """Valid layers of a layer product. offsets is an array of nray + 1
+    offsets of the layers of each ray, base and top are flat arrays of
+    the base and top altitude of layers, and fields is a dictionary of
+    flat arrays of other datasets (accessible by indexing)."""
+    def __init__(self, offsets, base, top, fields=None):
+        self.offsets = offsets
+        self.base = base
+        self.top = top
+        self._fields = dict(fields) if fields is not None else {}
+        self.nray = len(offsets) - 1
+
+    def __getitem__(self, name):
+        return self._fields[name]
+
+    def __contains__(self, name):
+        return name in self._fields
+
+    def keys(self):
+        return list(self._fields.keys())
+
+    @property
+    def nlayer(self):
+        """Number of layers of each ray."""
+        return np.diff(self.offsets)
+
+    def subset(self, start, stop):
+        """Return Layers of rays start to stop (exclusive). Arrays of the
+        result are views of arrays of self."""
+        if not (0 <= start <= stop <= self.nray):
+            raise IndexError('ray range out of range')
+        o1, o2 = self.offsets[start], self.offsets[stop]
+        return Layers(
+            self.offsets[start:stop+1] - o1,
+            self.base[o1:o2],
+            self.top[o1:o2],
+            {k: v[o1:o2] for k, v in self._fields.items()}
+        )
+
+
+def _str(name):
+    return name.decode('utf-8', 'replace') if type(name) is bytes else name
+
+
+def _pack(block, nlayer):
+    mask = np.arange(block.shape[1]) < nlayer[:,np.newaxis]
+    return block[mask]
+
+
+def read_layers(product, names=(), size=BLOCK_SIZE):
+    """Read valid layers of the datasets names of a CALIPSO layer product
+    (an instance of ccplot.hdf.HDF or ccplot.store.Store) into Layers.
+    Datasets are read in blocks of size rays, so that only the valid layers
+    are held in memory. Data are converted to float32, with NaN in place
+    of fill values (-9999 and the fillvalue attribute). Raises KeyError if
+    a dataset does not exist and ValueError if it does not have the shape of
+    Layer_Top_Altitude."""
+    top = product[LAYER_TOP]
+    shape = tuple(top.shape)
+    if len(shape) != 2:
+        raise ValueError('%s has shape %s, expected two dimensions' %
+            (_str(LAYER_TOP), shape))
+    datasets = [(name, product[name]) for name in names]
+    for name, ds in [(LAYER_BASE, product[LAYER_BASE])] + datasets:
+        if tuple(ds.shape) != shape:
+            raise ValueError('%s has shape %s, expected %s' %
+                (_str(name), tuple(ds.shape), shape))
+    nlayer = product[NUMBER_LAYERS][:]
+    if nlayer.ndim == 2: nlayer = nlayer[:,0]
+    if nlayer.shape != (shape[0],):
+        raise ValueError('%s has shape %s, expected (%d, 1)' %
+            (_str(NUMBER_LAYERS), nlayer.shape, shape[0]))
+    nlayer = np.clip(nlayer.astype(np.int64), 0, shape[1])
+    offsets = np.zeros(shape[0] + 1, dtype=np.int64)
+    np.cumsum(nlayer, out=offsets[1:])
+
+    def read(ds):
+        fill = [FILL_VALUE]
+        if b'fillvalue' in ds.attributes:
+            fill.append(ds.attributes[b'fillvalue'])
+        out = np.empty(offsets[-1], dtype=np.float32)
+        for i, block in ds.iter_blocks(0, size):
+            data = _pack(block, nlayer[i:i+len(block)]).astype(np.float32)
+            data[np.isin(data, fill)] = np.nan
+            out[offsets[i]:offsets[i+len(block)]] = data
+        return out
+
+    return Layers(
+        offsets,
+        read(product[LAYER_BASE]),
+        read(top),
+        {name: read(ds) for name, ds in datasets}
+    )
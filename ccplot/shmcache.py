@@ -0,0 +1,349 @@
+"""Shared-memory cache of datasets across processes.
+
+ccplot.hdf.HDF opened with shared_cache=True publishes every dataset it
+reads, whole, into a multiprocessing.shared_memory segment. Segments are
+named after the identity of the file (device, inode, size and modification
+time) and the name of the dataset. Other processes which read the same
+dataset attach to the segment and get a read-only view of it instead of
+reading the file again. A process which finds no segment creates it and
+reads the dataset into it while holding a lock on the segment, so that
+processes started at the same time wait for the read instead of
+duplicating it.
+
+The header of a segment holds the number of attached processes, the PID
+of the process which created it and the time of the last attach. The last
+process to detach from a segment removes it together with its lock file.
+Each process detaches from the least recently used segments once it has
+more than SHARED_CACHE_SIZE bytes attached, and from all segments on exit.
+Memory stays mapped for as long as arrays returned from a segment are
+referenced.
+
+A process which is killed does not detach from its segments. A segment is
+stale if it is still being filled, but the process which created it is no
+longer running, or if the process which created it is no longer running and
+no process has attached to it for SHARED_CACHE_MAX_AGE seconds. Stale
+segments are removed when a process finds them on attach, and by reclaim,
+which is called on first use of the cache. Processes which have a stale
+segment attached keep it until they detach.
+
+Reference counting uses file locks and is only available on POSIX systems.
+On other systems segments are released by the operating system once no
+process has them open.
+"""
+
+import os
+import sys
+import atexit
+import struct
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import multiprocessing.util
+from multiprocessing import shared_memory
+
+try: import fcntl
+except ImportError: fcntl = None
+
+# Maximum size in bytes of segments attached per process.
+SHARED_CACHE_SIZE = 1024*1024*1024
+
+# Time in seconds after the last attach after which a segment whose creator
+# is no longer running is stale.
+SHARED_CACHE_MAX_AGE = 24*60*60
+
+MAGIC = b'CCPLSHM2'
+# Magic, state, reference count, size, PID of the creator, time of the last
+# attach.
+HEADER = struct.Struct('8sqqqqd')
+HEADER_SIZE = 64
+
+# States of a segment.
+FILLING = 0
+READY = 1
+RECLAIMED = 2 # Removed as stale while still attached.
+
+PREFIX = 'ccplot_'
+
+# Directory of segments on Linux.
+SHM_DIR = '/dev/shm'
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _segment_name(key):
+    # Short enough for the 31-character limit on macOS.
+    return PREFIX + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+
+
+class _SharedMemory(shared_memory.SharedMemory):
+    """Segment which is not unmapped on garbage collection while arrays
+    still refer to it."""
+    def __del__(self):
+        try: self.close()
+        except BufferError: pass
+
+
+# Before Python 3.13, segments are registered on POSIX systems with
+# the resource tracker, which removes them when this process exits.
+_TRACKED = os.name == 'posix' and sys.version_info < (3, 13)
+
+
+def _shared_memory(name, create=False, size=0):
+    """Open a segment without registering it with the resource tracker."""
+    if sys.version_info >= (3, 13):
+        return _SharedMemory(name, create=create, size=size, track=False)
+    if not _TRACKED:
+        return _SharedMemory(name, create, size)
+    from multiprocessing import resource_tracker
+    shm = _SharedMemory(name, create=create, size=size)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _unlink(shm):
+    if _TRACKED:
+        # Register again so that unlink can unregister the segment.
+        from multiprocessing import resource_tracker
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def _running(pid):
+    """Return True if process pid is running or if it cannot be determined."""
+    if os.name != 'posix': return True
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    except OSError: pass
+    return True
+
+
+def _stale(header):
+    """Return True if a segment with header is stale (see above). Must be
+    called with the lock on the segment held."""
+    magic, state, refcount, size, pid, atime = header
+    if magic != MAGIC or state == RECLAIMED: return False
+    if state == FILLING:
+        # The creator holds the lock while filling the segment.
+        return fcntl is not None or not _running(pid)
+    return not _running(pid) and time.time() - atime > SHARED_CACHE_MAX_AGE
+
+
+def _reclaim(shm):
+    """Remove a stale segment. Must be called with the lock on the segment
+    held. Processes which have the segment attached keep it until they
+    detach, but do not remove it again."""
+    magic, state, refcount, size, pid, atime = HEADER.unpack_from(shm.buf)
+    HEADER.pack_into(shm.buf, 0, magic, RECLAIMED, refcount, size, pid, atime)
+    _unlink(shm)
+    try: shm.close()
+    except BufferError: pass
+
+
+class _SegmentLock(object):
+    """Exclusive lock on a segment held through a lock file. The lock file
+    is removed with the segment by remove."""
+    def __init__(self, name):
+        self.filename = os.path.join(tempfile.gettempdir(), name + '.lock')
+
+    def __enter__(self):
+        if fcntl is None: return self
+        while True:
+            f = open(self.filename, 'a')
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            # Retry if the lock file was removed by the previous holder of
+            # the lock.
+            try: st = os.stat(self.filename)
+            except FileNotFoundError: st = None
+            if st is not None and os.path.samestat(st, os.fstat(f.fileno())):
+                break
+            f.close()
+        self.f = f
+        return self
+
+    def remove(self):
+        """Remove the lock file. Must be called with the lock held."""
+        if fcntl is None: return
+        try: os.unlink(self.filename)
+        except FileNotFoundError: pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if fcntl is None: return
+        fcntl.lockf(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def _array(shm, dtype, shape):
+    # Arrays keep the buffer of the segment exported, which prevents
+    # the segment from being unmapped while they exist.
+    count = int(np.prod(shape))
+    return np.frombuffer(shm.buf, dtype=dtype, count=count,
+        offset=HEADER_SIZE).reshape(shape)
+
+
+def file_identity(filename):
+    """Return a tuple identifying the content of file filename."""
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def reclaim():
+    """Remove stale segments (see above) and lock files of removed segments.
+    Segments are listed in SHM_DIR, which exists only on Linux; on other
+    systems nothing is done. Returns the number of removed segments."""
+    try: filenames = os.listdir(SHM_DIR)
+    except OSError: return 0
+    n = 0
+    for name in filenames:
+        if not name.startswith(PREFIX): continue
+        with _SegmentLock(name) as lock:
+            try: shm = _shared_memory(name)
+            except FileNotFoundError:
+                lock.remove()
+                continue
+            if shm.size >= HEADER_SIZE and \
+               _stale(HEADER.unpack_from(shm.buf)):
+                _reclaim(shm)
+                lock.remove()
+                n += 1
+            else:
+                shm.close()
+    return n
+
+
+def get_cache():
+    """Return the shared cache of this process (created on first use).
+    Stale segments are removed with reclaim when the cache is created."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            reclaim()
+            _cache = SharedCache()
+            atexit.register(_cache.close)
+            # Worker processes of multiprocessing do not run atexit
+            # handlers, but run finalizers.
+            multiprocessing.util.Finalize(None, _cache.close, exitpriority=0)
+        return _cache
+
+
+class SharedCache(object):
+    """Cache of arrays in shared memory. Use get_cache to get the instance
+    of the process."""
+    def __init__(self, maxbytes=SHARED_CACHE_SIZE):
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._segments = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    def get(self, key, dtype, shape, fill):
+        """Return a read-only array of dtype and shape identified by key.
+        If no process has published the array yet, a new segment is
+        created and fill(out) is called to fill out (a writeable array of
+        dtype and shape) with the data."""
+        name = _segment_name(key)
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        with self._lock:
+            try:
+                shm, array = self._segments.pop(name)
+                self._segments[name] = (shm, array)
+                self.hits += 1
+                return array
+            except KeyError: pass
+            with _SegmentLock(name) as lock:
+                try:
+                    shm = _shared_memory(name)
+                except FileNotFoundError:
+                    shm = None
+                if shm is not None:
+                    header = HEADER.unpack_from(shm.buf)
+                    if _stale(header):
+                        _reclaim(shm)
+                        shm = None
+                if shm is not None:
+                    magic, state, refcount, size, pid, atime = header
+                    if magic != MAGIC or state != READY or size != nbytes:
+                        # Incomplete or foreign segment.
+                        shm.close()
+                        return None
+                    HEADER.pack_into(shm.buf, 0, magic, state,
+                        refcount + 1, size, pid, time.time())
+                    self.hits += 1
+                else:
+                    try:
+                        shm = _shared_memory(name, create=True,
+                            size=HEADER_SIZE + max(nbytes, 1))
+                    except FileExistsError:
+                        # Created by another process in the meantime
+                        # (without file locks).
+                        return None
+                    pid = os.getpid()
+                    HEADER.pack_into(shm.buf, 0, MAGIC, FILLING, 1, nbytes,
+                        pid, time.time())
+                    array = _array(shm, dtype, shape)
+                    try:
+                        fill(array)
+                    except:
+                        del array
+                        shm.close()
+                        _unlink(shm)
+                        lock.remove()
+                        raise
+                    del array
+                    HEADER.pack_into(shm.buf, 0, MAGIC, READY, 1, nbytes,
+                        pid, time.time())
+                    self.misses += 1
+            array = _array(shm, dtype, shape)
+            array.flags.writeable = False
+            self._segments[name] = (shm, array)
+            self._nbytes += nbytes
+            while self._nbytes > self.maxbytes and len(self._segments) > 1:
+                old_name, (old_shm, old_array) = \
+                    self._segments.popitem(last=False)
+                self._nbytes -= old_array.nbytes
+                self._detach(old_name, old_shm)
+            return array
+
+    def info(self):
+        """Return a dictionary of statistics of the cache: hits, misses,
+        number of attached segments (segments) and their size in bytes
+        (nbytes)."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'segments': len(self._segments),
+            'nbytes': self._nbytes,
+        }
+
+    def close(self):
+        """Detach from all segments."""
+        with self._lock:
+            while self._segments:
+                name, (shm, array) = self._segments.popitem()
+                del array
+                self._detach(name, shm)
+            self._nbytes = 0
+
+    def _detach(self, name, shm):
+        if fcntl is not None:
+            with _SegmentLock(name) as lock:
+                magic, state, refcount, size, pid, atime = \
+                    HEADER.unpack_from(shm.buf)
+                # A reclaimed segment is no longer named, and the name may
+                # refer to a new segment.
+                if state != RECLAIMED:
+                    HEADER.pack_into(shm.buf, 0, magic, state, refcount - 1,
+                        size, pid, atime)
+                    if refcount <= 1:
+                        _unlink(shm)
+                        lock.remove()
+        # If arrays still refer to the segment, it is unmapped once they
+        # are deleted.
+        try: shm.close()
+        except BufferError: pass
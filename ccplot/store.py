@@ -0,0 +1,487 @@
+"""Local store of HDF4 and HDF-EOS2 products.
+
+A store is a directory with a manifest (manifest.json) of datasets,
+attributes, dimensions and dimension maps, and the data of each dataset in
+raw .npy files, split into chunks along the first axis. A store is written
+from an open product with convert (or the ccplot-convert command) and
+opened with Store, which provides the same interface as ccplot.hdf.HDF
+(for HDF products) or ccplot.hdfeos.HDFEOS (for HDF-EOS products). Data
+are read through memory maps, without decompression.
+"""
+
+import os
+import sys
+import json
+import base64
+from errno import EINVAL
+import numpy as np
+from ccplot.hdf import _hyperslab, _squeeze
+from ccplot import hdf, hdfeos
+from .autostr import autostr, Autostr
+from .concurrency import run_async, submit
+
+if sys.version_info[0] == 2:
+    from UserDict import DictMixin as DictMixin
+else:
+    from collections.abc import Mapping
+    class DictMixin(Mapping):
+        def __iter__(self):
+            yield from self.keys()
+        def __len__(self):
+            return len(self.keys())
+
+FORMAT = 'ccplot-store'
+VERSION = 1
+MANIFEST = 'manifest.json'
+
+# Target size in bytes of a chunk written by convert.
+CHUNK_SIZE = 16*1024*1024
+
+
+def _name(x):
+    """Convert a name to a manifest key."""
+    return x.decode('utf-8', 'surrogateescape')
+
+
+def _bname(x):
+    """Convert a manifest key to a name."""
+    return x.encode('utf-8', 'surrogateescape')
+
+
+def _encode(value):
+    """Encode an attribute or Vdata value for the manifest."""
+    if type(value) is bytes:
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    value = np.asarray(value)
+    return {
+        'dtype': value.dtype.str,
+        'shape': list(value.shape),
+        'data': base64.b64encode(value.tobytes()).decode('ascii'),
+    }
+
+
+def _decode(value):
+    """Decode an attribute or Vdata value from the manifest."""
+    if 'bytes' in value:
+        return base64.b64decode(value['bytes'])
+    data = np.frombuffer(base64.b64decode(value['data']),
+        dtype=np.dtype(value['dtype']))
+    return data.reshape(value['shape'])[()]
+
+
+class Attributes(DictMixin, Autostr):
+    @autostr
+    def __init__(self, obj, attributes):
+        self._snapshot = {_bname(k): _decode(v) for k, v in attributes.items()}
+
+    def _load(self):
+        return self._snapshot
+
+    @autostr
+    def load_all(self):
+        """Return all attributes as a dictionary."""
+        return dict(self._snapshot)
+
+    @autostr
+    def __getitem__(self, key):
+        try: return self._snapshot[key]
+        except KeyError: raise KeyError(self._autostr(key))
+
+    @autostr
+    def __contains__(self, key):
+        return key in self._snapshot
+
+    @autostr
+    def keys(self):
+        return list(self._snapshot.keys())
+
+
+class Dataset(Autostr):
+    @autostr
+    def __init__(self, store, name, info):
+        self.store = store
+        self.name = name
+        self._info = info
+        self._path = os.path.join(store.filename, os.fsencode(info['path']))
+        self._chunks = {}
+        self.shape = np.array(info['shape'], dtype=np.int32)
+        self.shape.flags.writeable = False
+        self.rank = len(self.shape)
+        self.ndim = self.rank
+        self.dtype = np.dtype(info['dtype'])
+        if 'dims' in info:
+            self.dims = [_bname(d) for d in info['dims']]
+        self.attributes = Attributes(self, info['attributes'])
+
+    def __reduce__(self):
+        # Pickled without the memory-mapped chunks.
+        return (Dataset, (self.store, self.name, self._info))
+
+    @property
+    def chunks(self):
+        """Tuple of chunk lengths of the dataset in the store."""
+        return tuple(self._info['chunks'])
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[()]
+        if dtype is not None: data = data.astype(dtype, copy=False)
+        return data
+
+    @autostr
+    def __getitem__(self, key):
+        starta, edgesa, stridea, dims = _hyperslab(key, self.shape)
+        data = self._read(starta, edgesa, stridea)
+        return _squeeze(data, dims)
+
+    @autostr
+    def read_into(self, out, key=slice(None)):
+        """Read the part of the dataset selected by key into out and return
+        out. out must be a writeable C-contiguous array of dtype of
+        the dataset and of the shape which ds[key] would return."""
+        if not isinstance(out, np.ndarray) or out.dtype != self.dtype:
+            raise ValueError('out must be an array of dtype %s' % self.dtype)
+        starta, edgesa, stridea, dims = _hyperslab(key, self.shape)
+        shape = tuple(edgesa[dims])
+        if out.shape != shape:
+            raise ValueError('out has shape %s, expected %s' % (out.shape, shape))
+        if not out.flags.c_contiguous or not out.flags.writeable:
+            raise ValueError('out must be a writeable C-contiguous array')
+        self._read(starta, edgesa, stridea, out=out.reshape(edgesa))
+        return out
+
+    @autostr
+    def iter_blocks(self, axis=0, size=1000):
+        """Iterate over successive blocks of at most size elements along
+        axis. Yields tuples (offset, data), where offset is the start of
+        the block along axis.
+        """
+        if axis < 0: axis += self.rank
+        if axis < 0 or axis >= self.rank: raise IndexError('axis out of range')
+        if size <= 0: raise ValueError('size must be positive')
+        key = [slice(None)]*self.rank
+        for i in range(0, self.shape[axis], size):
+            key[axis] = slice(i, i + size)
+            starta, edgesa, stridea, dims = _hyperslab(tuple(key), self.shape)
+            yield i, self._read(starta, edgesa, stridea)
+
+    def read_async(self, key=slice(None), executor=None):
+        """Read the part of the dataset selected by key on a reader thread.
+        Returns an awaitable of the result of ds[key]. executor is
+        an instance of concurrent.futures.Executor or None for the default
+        pool of reader threads (see ccplot.concurrency)."""
+        return run_async(self.__getitem__, key, executor=executor)
+
+    def prefetch(self, key=slice(None), executor=None):
+        """Schedule reading of the part of the dataset selected by key on
+        a reader thread. Returns an instance of concurrent.futures.Future
+        of the result of ds[key]. executor is an instance of
+        concurrent.futures.Executor or None for the default pool of reader
+        threads (see ccplot.concurrency)."""
+        return submit(self.__getitem__, key, executor=executor)
+
+    def _chunk(self, i):
+        """Return a read-only memory map of chunk i."""
+        try: return self._chunks[i]
+        except KeyError: pass
+        filename = os.path.join(self._path, b'%d.npy' % i)
+        chunk = np.load(os.fsdecode(filename), mmap_mode='r')
+        self._chunks[i] = chunk
+        return chunk
+
+    def _read(self, start, edges, stride, out=None):
+        """Read a hyperslab into out (an array of shape edges) or a new
+        array. Only the chunks which overlap the hyperslab are mapped."""
+        if out is None:
+            out = np.empty(edges, dtype=self.dtype)
+        if self.rank == 0:
+            out[()] = self._chunk(0)
+            return out
+        if np.any(edges == 0):
+            return out
+        s, e, st = start[0], edges[0], stride[0]
+        n = self._info['chunks'][0]
+        rest = tuple(slice(s1, s1 + (e1 - 1)*st1 + 1, st1)
+            for s1, e1, st1 in zip(start[1:], edges[1:], stride[1:]))
+        for c in range(s//n, (s + (e - 1)*st)//n + 1):
+            lo = c*n
+            i0 = max(0, -((s - lo)//st))
+            i1 = min(e, -((s - lo - n)//st))
+            if i1 <= i0: continue
+            index = (slice(s + i0*st - lo, s + (i1 - 1)*st - lo + 1, st),)
+            out[i0:i1] = self._chunk(c)[index + rest]
+        return out
+
+
+class Vdata(DictMixin, Autostr):
+    @autostr
+    def __init__(self, store, name, info):
+        self.store = store
+        self.name = name
+        self.n_records = info['n_records']
+        self._fields = {_bname(k): _decode(v)
+            for k, v in info['fields'].items()}
+        # Character fields are stored as arrays of the characters of all
+        # records.
+        self._char = set(_bname(k) for k in info.get('char', []))
+        self.fields = list(self._fields.keys())
+
+    @autostr
+    def __getitem__(self, key):
+        if type(key) is tuple:
+            # Subset of records: vdata[field, index].
+            name, index = key
+            if type(name) is str: name = name.encode(self._encoding)
+            try: data = self._fields[name]
+            except KeyError: raise KeyError(self._autostr(name))
+            data = data.reshape(self.n_records, -1)
+            starta, edgesa, stridea, dims = \
+                _hyperslab(index, np.array([self.n_records], dtype=np.int32))
+            start, count, stride = starta[0], edgesa[0], stridea[0]
+            data = data[start:start + (count - 1)*stride + 1:stride].ravel() \
+                if count > 0 else data[0:0].ravel()
+        else:
+            name = key
+            try: data = self._fields[name]
+            except KeyError: raise KeyError(self._autostr(name))
+        if name in self._char:
+            return bytes(bytearray(data)).rstrip(b'\0')
+        if type(data) == np.ndarray and len(data) == 1:
+            return data[0]
+        return data
+
+    @autostr
+    def keys(self):
+        return self.fields
+
+
+class Swath(DictMixin, Autostr):
+    @autostr
+    def __init__(self, store, name, info):
+        self.store = store
+        self.name = name
+        self._info = info
+        self.attributes = Attributes(self, info['attributes'])
+        self.maps = {(_bname(geo), _bname(data)): (off, inc)
+            for geo, data, off, inc in info['maps']}
+
+    @autostr
+    def __getitem__(self, key):
+        try: info = self._info['fields'][_name(key)]
+        except KeyError: raise KeyError(self._autostr(key))
+        return Dataset(self.store, key, info)
+
+    @autostr
+    def __contains__(self, key):
+        return _name(key) in self._info['fields']
+
+    @autostr
+    def keys(self):
+        return [_bname(k) for k in self._info['fields']]
+
+    def read_many(self, keys):
+        """Read multiple fields of the swath. keys is a dictionary of field
+        names and keys as accepted by Dataset.__getitem__. Returns
+        a dictionary of field names and arrays."""
+        return {name: self[name][key] for name, key in keys.items()}
+
+    def prefetch(self, keys, executor=None):
+        """Schedule reading of multiple fields of the swath on a reader
+        thread. keys is a dictionary as accepted by read_many, or a list of
+        names of fields to be read whole. Returns an instance of
+        concurrent.futures.Future of the result of read_many."""
+        if not isinstance(keys, dict):
+            keys = {name: slice(None) for name in keys}
+        return submit(self.read_many, keys, executor=executor)
+
+
+class Store(DictMixin, Autostr):
+    """Store written by convert. type is 'hdf' if the store has datasets and
+    Vdata like ccplot.hdf.HDF, or 'hdfeos' if it has swaths like
+    ccplot.hdfeos.HDFEOS."""
+    def __init__(self, filename, encoding='utf-8', mode=None):
+        if mode not in (None, 'binary', 'text'):
+            raise ValueError('mode must be one of: None, "binary", "text"')
+        if mode is None:
+            mode = 'text' if type(filename) is str else 'binary'
+        self._mode = mode
+        self._encoding = encoding
+        filename = os.fsencode(filename)
+        self.filename = filename
+        with open(os.path.join(filename, os.fsencode(MANIFEST))) as f:
+            try: manifest = json.load(f)
+            except ValueError: manifest = None
+        if type(manifest) is not dict or manifest.get('format') != FORMAT:
+            raise IOError(EINVAL, 'Not a ccplot store', os.fsdecode(filename))
+        if manifest.get('version') != VERSION:
+            raise IOError(EINVAL, 'Unsupported store version %s' %
+                manifest.get('version'), os.fsdecode(filename))
+        self.type = manifest['type']
+        self._manifest = manifest
+        self.attributes = Attributes(self, manifest['attributes'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    @autostr
+    def __getitem__(self, key):
+        name = _name(key)
+        if self.type == 'hdfeos':
+            try: return Swath(self, key, self._manifest['swaths'][name])
+            except KeyError: raise KeyError(self._autostr(key))
+        if name in self._manifest['datasets']:
+            return Dataset(self, key, self._manifest['datasets'][name])
+        if name in self._manifest['vdata']:
+            return Vdata(self, key, self._manifest['vdata'][name])
+        raise KeyError(self._autostr(key))
+
+    @autostr
+    def __contains__(self, key):
+        name = _name(key)
+        if self.type == 'hdfeos':
+            return name in self._manifest['swaths']
+        return name in self._manifest['datasets'] or \
+            name in self._manifest['vdata']
+
+    @autostr
+    def keys(self):
+        if self.type == 'hdfeos':
+            return [_bname(k) for k in self._manifest['swaths']]
+        return [_bname(k) for k in self._manifest['datasets']] + \
+            [_bname(k) for k in self._manifest['vdata']
+                if self._manifest['vdata'][k]['pure']]
+
+    def read_many(self, keys):
+        """Read multiple datasets. keys is a dictionary of dataset names and
+        keys as accepted by Dataset.__getitem__. Returns a dictionary of
+        dataset names and arrays."""
+        return {name: self[name][key] for name, key in keys.items()}
+
+    def prefetch(self, keys, executor=None):
+        """Schedule reading of multiple datasets on a reader thread. keys
+        is a dictionary as accepted by read_many, or a list of names of
+        datasets to be read whole. Returns an instance of
+        concurrent.futures.Future of the result of read_many."""
+        if not isinstance(keys, dict):
+            keys = {name: slice(None) for name in keys}
+        return submit(self.read_many, keys, executor=executor)
+
+
+def is_store(filename):
+    """Return True if filename is a directory with a store manifest."""
+    filename = os.fsencode(filename)
+    return os.path.isfile(os.path.join(filename, os.fsencode(MANIFEST)))
+
+
+def _write_dataset(ds, path, relpath, chunk_size):
+    """Write dataset ds in chunks to directory path. Returns a manifest
+    entry of the dataset."""
+    os.makedirs(path, exist_ok=True)
+    shape = [int(n) for n in ds.shape]
+    if len(shape) == 0:
+        rows = 1
+        np.save(os.fsdecode(os.path.join(path, b'0.npy')), np.asarray(ds[()]))
+    else:
+        row_size = int(np.prod(shape[1:]))*ds.dtype.itemsize
+        rows = max(1, chunk_size//max(1, row_size))
+        for i, data in ds.iter_blocks(axis=0, size=rows):
+            np.save(os.fsdecode(os.path.join(path, b'%d.npy' % (i//rows))), data)
+    info = {
+        'path': relpath,
+        'shape': shape,
+        'dtype': ds.dtype.str,
+        'chunks': [min(rows, shape[0])] + shape[1:] if len(shape) else [],
+        'attributes': {_name(k): _encode(v)
+            for k, v in ds.attributes.load_all().items()},
+    }
+    if hasattr(ds, 'dims'):
+        info['dims'] = [_name(d) for d in ds.dims]
+    return info
+
+
+def convert(product, filename, chunk_size=CHUNK_SIZE):
+    """Write product (an instance of ccplot.hdf.HDF or ccplot.hdfeos.HDFEOS
+    opened in binary mode) to a store in directory filename. Data are
+    written in chunks of about chunk_size bytes. Datasets of unsupported
+    data types are skipped. Returns a list of names of skipped datasets."""
+    filename = os.fsencode(filename)
+    os.makedirs(filename, exist_ok=True)
+    skipped = []
+    manifest = {
+        'format': FORMAT,
+        'version': VERSION,
+        'attributes': {_name(k): _encode(v)
+            for k, v in product.attributes.load_all().items()},
+    }
+    if isinstance(product, hdfeos.HDFEOS):
+        manifest['type'] = 'hdfeos'
+        swaths = {}
+        for i, swath_name in enumerate(product.keys()):
+            swath = product[swath_name]
+            fields = {}
+            for j, name in enumerate(swath.keys()):
+                relpath = 's%d/d%d' % (i, j)
+                try: ds = swath[name]
+                except NotImplementedError:
+                    skipped.append(swath_name + b'/' + name)
+                    continue
+                fields[_name(name)] = _write_dataset(ds,
+                    os.path.join(filename, os.fsencode(relpath)),
+                    relpath, chunk_size)
+            swaths[_name(swath_name)] = {
+                'attributes': {_name(k): _encode(v)
+                    for k, v in swath.attributes.load_all().items()},
+                'maps': [[_name(geo), _name(data), int(off), int(inc)]
+                    for (geo, data), (off, inc) in swath.maps.items()],
+                'fields': fields,
+            }
+        manifest['swaths'] = swaths
+    else:
+        manifest['type'] = 'hdf'
+        datasets = {}
+        for i, name in enumerate(product._list_datasets()):
+            relpath = 'd%d' % i
+            try: ds = product[name]
+            except NotImplementedError:
+                skipped.append(name)
+                continue
+            datasets[_name(name)] = _write_dataset(ds,
+                os.path.join(filename, os.fsencode(relpath)),
+                relpath, chunk_size)
+        pure = set(product._list_vdata())
+        vdata = {}
+        for name, vdata_class in product._walk_vdata():
+            if len(name) == 0 or _name(name) in vdata: continue
+            try:
+                vd = hdf.Vdata(product, name)
+                fields = {}
+                char = []
+                for field in vd.keys():
+                    data = vd.hdf._read_vdata(name, field)
+                    if type(data) is bytes:
+                        char.append(_name(field))
+                        data = vd.hdf._read_vdata(name, field, raw=True)
+                    fields[_name(field)] = _encode(data)
+            except (KeyError, NotImplementedError):
+                skipped.append(name)
+                continue
+            vdata[_name(name)] = {
+                'n_records': int(vd.hdf._vsattach(name)['n_records']),
+                'pure': name in pure,
+                'fields': fields,
+                'char': char,
+            }
+        manifest['datasets'] = datasets
+        manifest['vdata'] = vdata
+    # The manifest is written last, so that an incomplete store is not
+    # recognized.
+    tmp = os.path.join(filename, os.fsencode(MANIFEST + '.tmp'))
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(filename, os.fsencode(MANIFEST)))
+    return skipped
@@ -32,6 +32,8 @@ if sys.platform == 'win32':
     for filename in dlls:
         shutil.copy(filename, 'ccplot')
     sys_package_data = ['hdf.dll', 'mfhdf.dll']
+    openmp_compile_args = ['/openmp']
+    openmp_link_args = []
 else:
     hdf_libraries = ['mfhdf', 'df', 'jpeg', 'z', 'gctp']
     hdf_include_dirs = [
@@ -45,9 +47,15 @@ else:
     hdfeos_include_dirs = []
     hdfeos_library_dirs = []
     sys_package_data = []
+    openmp_compile_args = ['-fopenmp']
+    openmp_link_args = ['-fopenmp']
 
 if sys.platform == 'darwin':
     hdfeos_libraries += ['Gctp']
+    # Apple clang does not support OpenMP. ccplot.algorithms and ccplot.cctk
+    # fall back to a single thread.
+    openmp_compile_args = []
+    openmp_link_args = []
 
 
 setup(
@@ -78,7 +86,10 @@ setup(
         'Topic :: Scientific/Engineering :: Visualization',
     ],
     entry_points={
-        'console_scripts': ['ccplot = ccplot.bin.ccplot:main_wrapper'],
+        'console_scripts': [
+            'ccplot = ccplot.bin.ccplot:main_wrapper',
+            'ccplot-convert = ccplot.bin.ccplot_convert:main_wrapper',
+        ],
     },
     packages=[
         'ccplot',
@@ -98,7 +109,7 @@ setup(
         'numpy',
     ],
     data_files=[('share/doc/ccplot', ['NEWS', 'LICENSE']),
-                ('share/man/man1', ['man/ccplot.1'])],
+                ('share/man/man1', ['man/ccplot.1', 'man/ccplot-convert.1'])],
     include_package_data=True,
     package_data={'ccplot': ['cmap/*'] + sys_package_data},
     ext_modules=[
@@ -106,6 +117,8 @@ setup(
             'ccplot.cctk',
             ['ccplot/cctk.c'],
             include_dirs=numpy_include_dirs,
+            extra_compile_args=openmp_compile_args,
+            extra_link_args=openmp_link_args,
         ),
         Extension(
             'ccplot.hdf',
@@ -125,6 +138,8 @@ setup(
             'ccplot.algorithms',
             ['ccplot/algorithms.pyx'],
             include_dirs=numpy_include_dirs,
+            extra_compile_args=openmp_compile_args,
+            extra_link_args=openmp_link_args,
         ),
     ],
 )
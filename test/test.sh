@@ -113,6 +113,15 @@ trajticks
 watercolor
 EOF
 
+testing "profile regridding algorithms"
+check regridcompare
+
+testing "swath regridding algorithms"
+check swathcompare
+
+testing "packed layers"
+check layercompare
+
 testing "print info on CALIPSO"
 check ccplot -i CAL_LID_L1-ValStage1-V3-01.2007-06-12T03-42-18ZN.hdf
 expect <<EOF
@@ -185,4 +194,18 @@ check ccplot -o calipso532-layer.png -c calipso-backscatter.cmap -a 30 -x 68S..8
 expect ""
 check imgcompare calipso532-layer.png calipso532-layer.ref.png
 
+testing "ccplot-convert of CALIPSO layer product"
+check ccplot-convert CAL_LID_L2_01kmCLay-Prov-V1-20.2007-06-12T03-42-18ZN.hdf CAL_LID_L2_01kmCLay-Prov-V1-20.2007-06-12T03-42-18ZN.ccplot
+check storecompare CAL_LID_L2_01kmCLay-Prov-V1-20.2007-06-12T03-42-18ZN.hdf CAL_LID_L2_01kmCLay-Prov-V1-20.2007-06-12T03-42-18ZN.ccplot
+check ccplot -o calipso532-layer-store.png -c calipso-backscatter.cmap -a 30 -x 68S..81S,40W..140W -y 0..25000 calipso532-layer CAL_LID_L2_01kmCLay-Prov-V1-20.2007-06-12T03-42-18ZN.ccplot
+expect ""
+check imgcompare calipso532-layer-store.png calipso532-layer.ref.png
+
+testing "ccplot-convert of CloudSat 2B-GEOPROF"
+check ccplot-convert 2009037050924_14779_CS_2B-GEOPROF_GRANULE_P_R04_E02.hdf 2009037050924_14779_CS_2B-GEOPROF_GRANULE_P_R04_E02.ccplot
+check storecompare 2009037050924_14779_CS_2B-GEOPROF_GRANULE_P_R04_E02.hdf 2009037050924_14779_CS_2B-GEOPROF_GRANULE_P_R04_E02.ccplot
+check ccplot -o cloudsat-reflec-store.png -c cloudsat-reflectivity.cmap -a 15 -x 24.60S..31S,50W..60W -y -1000..18000 cloudsat-reflec 2009037050924_14779_CS_2B-GEOPROF_GRANULE_P_R04_E02.ccplot
+expect ""
+check imgcompare cloudsat-reflec-store.png cloudsat-reflec-ccplot.org.ref.png
+
 complete